@@ -1,14 +1,47 @@
 import gradio as gr
 import os
+import torch
 
 # Import from our modules
+import config
+from models import warmup
 from constants import class_names
+from classification import get_text_embeddings
+from legend import prerender_legends
+from metrics import start_metrics_server
 from segmentation import segment_image
-from utils import process_url, process_person_and_garment
+from utils import process_url, stream_person_and_garment
+from workers import InferencePool, PoolBusyError
+from streaming import StreamSession
 
 # Define fixed size for consistent image display
 FIXED_IMAGE_SIZE = (400, 400)
 
+# Worker pool, started in __main__ when GARMENT_SEG_WORKER_PROCESSES > 0
+inference_pool = None
+
+def handle_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay):
+    """Stream a request's results in-process, or run it on the worker pool when one is configured"""
+    if inference_pool is None:
+        # Classification text first, then the overlay, then the whole gallery
+        yield from stream_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay, FIXED_IMAGE_SIZE)
+        return
+    try:
+        yield inference_pool.process_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay, FIXED_IMAGE_SIZE)
+    except PoolBusyError:
+        yield [gr.update(value=None)] * 4, "The server is busy, please try again in a moment"
+
+def handle_stream_frame(frame, garment_image, session):
+    """Overlay one webcam frame, keeping the stream's session in Gradio state"""
+    if frame is None or garment_image is None:
+        return gr.skip(), "Provide a garment image and start the webcam", session
+    if session is None:
+        # Streams always run in-process: the session holds the previous label map
+        session = StreamSession(garment_image, FIXED_IMAGE_SIZE)
+    overlay = session.process(frame)
+    # Dropped frames (and garments without segments) leave the last overlay on screen
+    return (gr.skip() if overlay is None else overlay), session.status(), session
+
 def create_interface():
     """Create the Gradio interface with improved image consistency"""
     with gr.Blocks(title="Garment-based Segmentation") as demo:
@@ -62,12 +95,44 @@ def create_interface():
                 )
                 result_text = gr.Textbox(label="Result", interactive=False, lines=4)
         
-        # Set up event handler for dual image processing
+        # Set up event handler for dual image processing; with a worker pool, as many requests
+        # run at once as the pool accepts, so its workers and its backpressure are both used
         process_button.click(
-            fn=lambda p_img, g_img, orig, seg, over: process_person_and_garment(p_img, g_img, orig, seg, over, FIXED_IMAGE_SIZE),
+            fn=handle_person_and_garment,
             inputs=[person_image, garment_image, show_original_dual, show_segmentation_dual, show_overlay_dual],
-            outputs=[dual_output_images, result_text]
+            outputs=[dual_output_images, result_text],
+            api_name="process_person_and_garment",
+            concurrency_limit=inference_pool.max_pending if inference_pool is not None else "default"
+        )
+        
+        # Live webcam segmentation for the garment above
+        gr.Markdown("### Live Webcam")
+        with gr.Row():
+            with gr.Column(scale=1):
+                webcam_image = gr.Image(
+                    type="pil",
+                    label="Webcam",
+                    sources=["webcam"],
+                    streaming=True,
+                    height=300,
+                    elem_id="webcam-stream"
+                )
+            with gr.Column(scale=2):
+                stream_output = gr.Image(label="Live overlay", height=400, elem_id="stream-output")
+                stream_text = gr.Textbox(label="Stream", interactive=False, lines=5)
+        stream_session = gr.State(None)
+        
+        # Frames that arrive while one is being processed are replaced by the newest one
+        webcam_image.stream(
+            fn=handle_stream_frame,
+            inputs=[webcam_image, garment_image, stream_session],
+            outputs=[stream_output, stream_text, stream_session],
+            stream_every=config.STREAM_INTERVAL,
+            trigger_mode="always_last",
+            show_progress="hidden"
         )
+        # A new garment starts a new session, so it is classified again
+        garment_image.change(fn=lambda: None, outputs=stream_session)
         
         # Add custom CSS for consistent image sizes and improved UI
         gr.HTML("""
@@ -132,7 +197,34 @@ def create_interface():
     
     return demo
 
+def build_app():
+    """Create the interface with its request queue configured"""
+    demo = create_interface()
+    # Bounded queue and per-handler concurrency, so bursts wait instead of piling onto the models
+    demo.queue(
+        max_size=config.APP_QUEUE_MAX_SIZE or None,
+        default_concurrency_limit=config.APP_CONCURRENCY_LIMIT
+    )
+    return demo
+
 # Main application entry point
 if __name__ == "__main__":
-    demo = create_interface()
+    if config.WARMUP_MODELS and not config.WORKER_PROCESSES:
+        # Pay the model loading cost before the first request instead of during it (a worker
+        # pool warms the models up itself, single-threaded, before it forks)
+        warmup()
+        get_text_embeddings()
+    prerender_legends()
+    
+    if config.METRICS_PORT:
+        # Prometheus scrape endpoint next to the app
+        start_metrics_server(config.METRICS_PORT)
+    
+    if config.TORCH_THREADS:
+        torch.set_num_threads(config.TORCH_THREADS)
+    if config.WORKER_PROCESSES:
+        # Workers each own a slice of the cores and share the parent's model weights
+        inference_pool = InferencePool()
+    
+    demo = build_app()
     demo.launch()
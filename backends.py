@@ -0,0 +1,228 @@
+import os
+import re
+import hashlib
+import inspect
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+import config
+
+# Inference backends available for both models:
+#   "fp32" - eager PyTorch in float32 (the reference)
+#   "bf16" - eager PyTorch with bfloat16 weights and activations
+#   "int8" - eager PyTorch with dynamically quantised int8 Linear layers
+#   "onnx" - an exported ONNX Runtime graph (requires the onnxruntime package)
+BACKENDS = ("fp32", "bf16", "int8", "onnx")
+
+def projected_features(output):
+    """Return the projected embeddings from a CLIP get_*_features call"""
+    # Newer transformers return a model output instead of a bare tensor
+    if isinstance(output, torch.Tensor):
+        return output
+    return output.pooler_output
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+def weights_revision(model):
+    """Hub commit hash of the loaded weights, or a hash of the weights themselves for local models"""
+    model_config = model.config
+    revision = getattr(model_config, "_commit_hash", None) or getattr(model_config, "_weights_hash", None)
+    # The bf16 wrappers hold the converted module; ONNX sessions only have what was hashed at export
+    module = model if isinstance(model, nn.Module) else getattr(model, "model", None)
+    if revision or not isinstance(module, nn.Module):
+        return revision
+    
+    # Hashed once per loaded model; the config travels with the backend wrappers
+    digest = hashlib.blake2b(digest_size=8)
+    for name, tensor in module.state_dict().items():
+        if isinstance(tensor, torch.Tensor):
+            digest.update(name.encode("utf-8"))
+            digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    model_config._weights_hash = digest.hexdigest()
+    return model_config._weights_hash
+
+def onnx_path(source, component, revision=None):
+    """Where the ONNX graph of a model component exported from the given weights revision is stored"""
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(source)).strip("_")
+    if revision:
+        name = f"{name}-{revision}"
+    return os.path.join(config.ONNX_DIR, name, f"{component}.onnx")
+
+def _quantize_int8(model):
+    quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    quantized.backend = "int8"
+    return quantized
+
+def _onnxruntime_session(path):
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("The 'onnx' backend requires the onnxruntime package (pip install onnxruntime)") from e
+    return onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+def _export_onnx(module, args, path, input_names, output_names, dynamic_axes):
+    """Export a module with the TorchScript-based exporter"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            module, args, tmp_path,
+            input_names=input_names, output_names=output_names,
+            dynamic_axes=dynamic_axes, opset_version=17, **kwargs,
+        )
+    os.replace(tmp_path, path)
+
+# SegFormer backends
+
+class _SegformerLogits(nn.Module):
+    """Export wrapper returning only the logits"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+class Bf16Segformer:
+    """SegFormer running in bfloat16, with float32 inputs and logits"""
+
+    backend = "bf16"
+
+    def __init__(self, model):
+        self.model = model.to(torch.bfloat16)
+        self.config = model.config
+
+    def __call__(self, pixel_values, **kwargs):
+        logits = self.model(pixel_values=pixel_values.to(torch.bfloat16), **kwargs).logits
+        return SimpleNamespace(logits=logits.float())
+
+class OnnxSegformer:
+    """SegFormer running as an ONNX Runtime graph"""
+
+    backend = "onnx"
+
+    def __init__(self, path, model_config):
+        self.session = _onnxruntime_session(path)
+        self.config = model_config
+
+    def __call__(self, pixel_values, **kwargs):
+        logits = self.session.run(["logits"], {"pixel_values": pixel_values.numpy()})[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+def export_segformer_onnx(model, path, image_size=512):
+    """Export the SegFormer logits to ONNX with a dynamic batch and image size"""
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    _export_onnx(
+        _SegformerLogits(model).eval(), (dummy,), path,
+        ["pixel_values"], ["logits"],
+        {"pixel_values": {0: "batch", 2: "height", 3: "width"}, "logits": {0: "batch", 2: "logit_height", 3: "logit_width"}},
+    )
+
+def wrap_segformer(model, backend=None, source=None, reexport=False):
+    """Return SegFormer running on the given backend (the fp32 model is converted in place)"""
+    backend = backend or config.SEGFORMER_BACKEND
+    _check_backend(backend)
+    if backend == "bf16":
+        return Bf16Segformer(model)
+    if backend == "int8":
+        return _quantize_int8(model)
+    if backend == "onnx":
+        # Graphs are keyed by the weights they were exported from, so updated weights are re-exported
+        path = onnx_path(source or model.config._name_or_path, "segformer", weights_revision(model))
+        if reexport or not os.path.exists(path):
+            export_segformer_onnx(model, path)
+        return OnnxSegformer(path, model.config)
+    return model
+
+# Fashion-CLIP backends
+
+class _ClipImageFeatures(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return projected_features(self.model.get_image_features(pixel_values=pixel_values))
+
+class _ClipTextFeatures(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return projected_features(self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+
+class Bf16Clip:
+    """CLIP running in bfloat16, with float32 inputs and embeddings"""
+
+    backend = "bf16"
+
+    def __init__(self, model):
+        self.logit_scale = model.logit_scale.detach().float()
+        self.model = model.to(torch.bfloat16)
+        self.config = model.config
+
+    def get_image_features(self, pixel_values, **kwargs):
+        return projected_features(self.model.get_image_features(pixel_values=pixel_values.to(torch.bfloat16), **kwargs)).float()
+
+    def get_text_features(self, **kwargs):
+        return projected_features(self.model.get_text_features(**kwargs)).float()
+
+class OnnxClip:
+    """CLIP image and text towers running as ONNX Runtime graphs"""
+
+    backend = "onnx"
+
+    def __init__(self, image_path, text_path, model_config, logit_scale):
+        self.image_session = _onnxruntime_session(image_path)
+        self.text_session = _onnxruntime_session(text_path)
+        self.config = model_config
+        self.logit_scale = logit_scale
+
+    def get_image_features(self, pixel_values, **kwargs):
+        return torch.from_numpy(self.image_session.run(None, {"pixel_values": pixel_values.numpy()})[0])
+
+    def get_text_features(self, input_ids, attention_mask=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        feeds = {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()}
+        return torch.from_numpy(self.text_session.run(None, feeds)[0])
+
+def export_clip_onnx(model, image_path, text_path):
+    """Export the CLIP image and text towers to ONNX with dynamic batch sizes"""
+    image_size = model.config.vision_config.image_size
+    _export_onnx(
+        _ClipImageFeatures(model).eval(), (torch.zeros(1, 3, image_size, image_size),), image_path,
+        ["pixel_values"], ["image_embeds"],
+        {"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+    )
+    input_ids = torch.ones(2, 8, dtype=torch.long)
+    _export_onnx(
+        _ClipTextFeatures(model).eval(), (input_ids, torch.ones_like(input_ids)), text_path,
+        ["input_ids", "attention_mask"], ["text_embeds"],
+        {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "text_embeds": {0: "batch"}},
+    )
+
+def wrap_clip(model, backend=None, source=None, reexport=False):
+    """Return CLIP running on the given backend (the fp32 model is converted in place)"""
+    backend = backend or config.CLIP_BACKEND
+    _check_backend(backend)
+    if backend == "bf16":
+        return Bf16Clip(model)
+    if backend == "int8":
+        return _quantize_int8(model)
+    if backend == "onnx":
+        source, revision = source or model.config._name_or_path, weights_revision(model)
+        image_path, text_path = onnx_path(source, "clip_image", revision), onnx_path(source, "clip_text", revision)
+        if reexport or not (os.path.exists(image_path) and os.path.exists(text_path)):
+            export_clip_onnx(model, image_path, text_path)
+        return OnnxClip(image_path, text_path, model.config, model.logit_scale.detach().float())
+    return model
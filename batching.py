@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import config
+
+# Sentinel used to stop a batcher's worker thread
+_STOP = object()
+
+class MicroBatcher:
+    """Gather concurrent single-item requests and run them as one batched call"""
+
+    def __init__(self, batch_fn, max_batch_size=None, max_wait_ms=None, name="micro-batcher"):
+        # batch_fn maps a list of items to a list of results in the same order
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size or config.MAX_BATCH_SIZE
+        self.max_wait = (config.MAX_BATCH_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queue an item and return a Future for its result"""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Run a single item through the batcher and wait for its result"""
+        return self.submit(item).result()
+
+    def close(self):
+        """Finish the queued work and stop the worker thread"""
+        self._queue.put((_STOP, None))
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item, future = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [(item, future)]
+            
+            # Wait up to max_wait for more requests to share the forward pass
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item, future = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append((item, future))
+            
+            self._process(batch)
+
+    def _process(self, batch):
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self.batch_fn([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Retry one by one so a single bad input does not fail its neighbours
+            for item, future in batch:
+                try:
+                    future.set_result(self.batch_fn([item])[0])
+                except Exception as item_error:
+                    future.set_exception(item_error)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+# Shared batchers, one per batched entry point
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+def _reset_after_fork():
+    # Worker threads do not survive a fork; children start their own batchers
+    global _batchers_lock
+    _batchers.clear()
+    _batchers_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_batcher(name, batch_fn):
+    """Return the process-wide batcher registered under name, creating it on first use"""
+    with _batchers_lock:
+        batcher = _batchers.get(name)
+        if batcher is None:
+            batcher = MicroBatcher(batch_fn, name=f"{name}-batcher")
+            _batchers[name] = batcher
+        return batcher
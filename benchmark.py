@@ -0,0 +1,210 @@
+import json
+import time
+import platform
+import argparse
+import resource
+import tracemalloc
+
+import numpy as np
+import torch
+import transformers
+from PIL import Image
+
+import config
+from tiny_models import install_tiny_models
+from models import get_segformer, get_clip
+from constants import fashion_categories
+from classification import PROMPT_TEMPLATE
+from backends import projected_features
+from segmentation import upsample_argmax, logits_to_label_map
+from rendering import filter_label_map, colorize, blend_overlay, to_rgb_array
+from legend import render_legend, _cached_legend
+from preprocessing import segformer_pixel_values, clip_pixel_values, _image_tensors
+
+# Image sizes (width, height) benchmarked by default, from thumbnails to phone photos
+DEFAULT_SIZES = [(256, 256), (512, 512), (1024, 768), (2048, 1536), (4000, 3000)]
+
+# Garment selection used by the filtering, overlay and legend stages
+BENCHMARK_CLASSES = ["Upper-clothes", "Left-arm", "Right-arm"]
+
+FIXED_SIZE = (400, 400)
+
+def _parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def _random_image(size, seed=0):
+    """A random RGB image of size=(width, height)"""
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(fn, repeats, warmup=1):
+    """Time fn over repeats runs, then measure its traced peak allocation in one extra run"""
+    for _ in range(warmup):
+        fn()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    # tracemalloc slows Python-heavy code down, so it is kept out of the timed runs.
+    # It sees numpy and Python allocations, not torch's CPU allocator.
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "repeats": repeats,
+        "mean_ms": float(latencies_ms.mean()),
+        "min_ms": float(latencies_ms.min()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p90_ms": float(np.percentile(latencies_ms, 90)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "throughput_per_s": float(1000.0 / latencies_ms.mean()),
+        "peak_traced_bytes": int(peak),
+        "max_rss_bytes": _max_rss_bytes(),
+    }
+
+def _stages(image):
+    """Build the stage callables for one input image, in pipeline order"""
+    segformer_processor, segformer_model = get_segformer()
+    clip_model, clip_processor = get_clip()
+
+    # Inputs each stage starts from, computed once outside the timings
+    segformer_inputs = segformer_processor(images=image, return_tensors="pt")
+    clip_inputs = clip_processor(images=image, return_tensors="pt")
+    text_inputs = clip_processor(text=[PROMPT_TEMPLATE.format(category=c) for c in fashion_categories], return_tensors="pt", padding=True)
+    with torch.no_grad():
+        logits = segformer_model(**segformer_inputs).logits[0]
+    label_map = logits_to_label_map(logits, image.size, "full")
+    filtered = filter_label_map(label_map, BENCHMARK_CLASSES)
+    image_array = to_rgb_array(image)
+    colored = colorize(filtered)
+    overlay = blend_overlay(image_array, filtered)
+
+    def segformer_forward():
+        with torch.no_grad():
+            segformer_model(**segformer_inputs)
+
+    def clip_text_tower():
+        with torch.no_grad():
+            projected_features(clip_model.get_text_features(**text_inputs))
+
+    def clip_image_tower():
+        with torch.no_grad():
+            projected_features(clip_model.get_image_features(**clip_inputs))
+
+    # Tensor preprocessing, including the one-off conversion of the image to a tensor
+    def preprocess_segformer_tensor():
+        _image_tensors.clear()
+        segformer_pixel_values([image], segformer_processor)
+
+    def preprocess_clip_tensor():
+        _image_tensors.clear()
+        clip_pixel_values([image], clip_processor)
+
+    def preprocess_shared_tensor():
+        _image_tensors.clear()
+        segformer_pixel_values([image], segformer_processor)
+        clip_pixel_values([image], clip_processor)
+
+    def legend_cold():
+        _cached_legend.cache_clear()
+        render_legend(BENCHMARK_CLASSES)
+
+    def final_resizes():
+        image.resize(FIXED_SIZE)
+        Image.fromarray(colored).resize(FIXED_SIZE)
+        Image.fromarray(overlay).resize(FIXED_SIZE)
+
+    return {
+        "preprocess_segformer": lambda: segformer_processor(images=image, return_tensors="pt"),
+        "preprocess_clip": lambda: clip_processor(images=image, return_tensors="pt"),
+        "preprocess_segformer_tensor": preprocess_segformer_tensor,
+        "preprocess_clip_tensor": preprocess_clip_tensor,
+        "preprocess_shared_tensor": preprocess_shared_tensor,
+        "clip_text_tower": clip_text_tower,
+        "clip_image_tower": clip_image_tower,
+        "segformer_forward": segformer_forward,
+        "upsample_argmax_full": lambda: upsample_argmax(logits, image.size[::-1]),
+        "upsample_argmax_display": lambda: logits_to_label_map(logits, image.size, "display", FIXED_SIZE),
+        "upsample_argmax_logits": lambda: logits_to_label_map(logits, image.size, "logits", FIXED_SIZE),
+        "mask_filtering": lambda: filter_label_map(label_map, BENCHMARK_CLASSES),
+        "colorize": lambda: colorize(filtered),
+        "overlay": lambda: blend_overlay(image_array, filtered),
+        "legend_cold": legend_cold,
+        "legend_cached": lambda: render_legend(BENCHMARK_CLASSES),
+        "final_resizes": final_resizes,
+    }
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeats=10, stages=None, seed=0):
+    """Benchmark every stage at every image size and return a JSON-serialisable report"""
+    # Tiny random-weight models: no network, and the persisted embedding cache is left alone
+    config.PERSIST_TEXT_EMBEDDINGS = False
+    install_tiny_models(seed)
+
+    results = []
+    for size in sizes:
+        image = _random_image(size, seed)
+        for stage, fn in _stages(image).items():
+            if stages and stage not in stages:
+                continue
+            result = {"stage": stage, "size": f"{size[0]}x{size[1]}", "megapixels": size[0] * size[1] / 1e6}
+            result.update(measure(fn, repeats))
+            results.append(result)
+            print(f"{stage:<28} {result['size']:>10}  p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+                  f"peak {result['peak_traced_bytes'] / 2**20:8.1f} MiB", flush=True)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "segmentation_tile_rows": config.SEGMENTATION_TILE_ROWS,
+        },
+        "results": results,
+        "max_rss_bytes": _max_rss_bytes(),
+    }
+
+def compare(report, baseline):
+    """Print the p50 ratio of every stage against a previous report"""
+    previous = {(r["stage"], r["size"]): r for r in baseline["results"]}
+    for result in report["results"]:
+        before = previous.get((result["stage"], result["size"]))
+        if before is None:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float("inf")
+        print(f"{result['stage']:<28} {result['size']:>10}  {before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms  (x{ratio:.2f})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage-level benchmarks with tiny random-weight models (offline)")
+    parser.add_argument("--sizes", nargs="+", type=_parse_size, default=DEFAULT_SIZES, help="Image sizes as WIDTHxHEIGHT")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed runs per stage and size")
+    parser.add_argument("--stages", nargs="+", help="Only run these stages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    parser.add_argument("--compare", help="Previous JSON report to compare p50 latencies against")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.repeats, args.stages, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
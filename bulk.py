@@ -0,0 +1,287 @@
+import os
+import re
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+
+from PIL import Image
+
+import config
+from segmentation import predict_label_maps
+from classification import get_segments_for_garments
+from rendering import filter_label_map
+from masks import write_palette_png
+
+# Offline bulk segmentation of person/garment pairs as a streaming pipeline:
+#   decode threads -> batched CLIP + SegFormer -> writer threads
+# Every stage is connected by a bounded queue, so memory stays flat however large the
+# input is, and each finished pair is appended to a journal so an interrupted run resumes.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+JOURNAL_NAME = "journal.jsonl"
+
+# Marks the end of a queue
+_DONE = object()
+
+def _safe_id(text):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_")
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def pairs_from_directory(directory):
+    """Pair <directory>/persons/<name>.* with <directory>/garments/<name>.* by file name"""
+    def images(subdirectory):
+        path = os.path.join(directory, subdirectory)
+        return {_stem(name): os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith(IMAGE_EXTENSIONS)}
+
+    persons, garments = images("persons"), images("garments")
+    return [{"id": _safe_id(name), "person": persons[name], "garment": garments[name]} for name in sorted(persons) if name in garments]
+
+def pairs_from_manifest(path):
+    """Read pairs from a JSONL or CSV manifest with person, garment and optional id fields"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    pairs = []
+    for row in rows:
+        person, garment = (os.path.join(base, row[key]) for key in ("person", "garment"))
+        pair_id = row.get("id") or f"{_stem(person)}__{_stem(garment)}"
+        pairs.append({"id": _safe_id(pair_id), "person": person, "garment": garment})
+    return pairs
+
+def read_journal(output_dir):
+    """Ids of the pairs a previous run already finished (failed pairs are retried)"""
+    path = os.path.join(output_dir, JOURNAL_NAME)
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by an interrupted run
+                if record.get("status") in ("ok", "no_garment"):
+                    done.add(record["id"])
+    return done
+
+class StageTimer:
+    """Thread-safe busy seconds and item counts per pipeline stage"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, items=1):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.items[stage] = self.items.get(stage, 0) + items
+
+class BulkPipeline:
+    """Streaming decode -> classify/segment -> write pipeline over a list of pairs"""
+
+    def __init__(self, output_dir, batch_size=None, decode_threads=4, writer_threads=2, queue_size=32, resolution="full"):
+        self.output_dir = output_dir
+        self.batch_size = batch_size or config.MAX_BATCH_SIZE
+        self.decode_threads = decode_threads
+        self.writer_threads = writer_threads
+        self.queue_size = queue_size
+        self.resolution = resolution
+        self.timer = StageTimer()
+        self.counts = {"ok": 0, "error": 0, "no_garment": 0}
+        self._journal_lock = threading.Lock()
+        os.makedirs(os.path.join(output_dir, "label_maps"), exist_ok=True)
+
+    # Stage 1: decode pairs in parallel
+
+    def _decode(self, todo, decoded):
+        while True:
+            pair = todo.get()
+            if pair is _DONE:
+                decoded.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                with Image.open(pair["person"]) as person, Image.open(pair["garment"]) as garment:
+                    item = dict(pair, person_image=person.convert("RGB"), garment_image=garment.convert("RGB"))
+            except Exception as e:
+                item = dict(pair, error=f"decode: {e}")
+            self.timer.add("decode", time.perf_counter() - start)
+            decoded.put(item)
+
+    # Stage 2: batched inference on the calling thread
+
+    def _next_batch(self, decoded, finished):
+        """Block for one decoded item, then take whatever else is ready up to the batch size"""
+        batch = []
+        while finished[0] < self.decode_threads and len(batch) < self.batch_size:
+            try:
+                item = decoded.get() if not batch else decoded.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                finished[0] += 1
+            else:
+                batch.append(item)
+        return batch
+
+    def _infer(self, items):
+        start = time.perf_counter()
+        garment_results = get_segments_for_garments([item["garment_image"] for item in items])
+        self.timer.add("clip", time.perf_counter() - start, len(items))
+
+        start = time.perf_counter()
+        label_maps = predict_label_maps([item["person_image"] for item in items], self.resolution)
+        self.timer.add("segformer", time.perf_counter() - start, len(items))
+
+        for item, (selected_class, segformer_idx, result_text), label_map in zip(items, garment_results, label_maps):
+            item.update(selected_class=selected_class, segformer_idx=segformer_idx, result_text=result_text, label_map=label_map)
+
+    def _process_batch(self, batch, written):
+        items = [item for item in batch if "error" not in item]
+        if items:
+            try:
+                self._infer(items)
+            except Exception:
+                # Retry one by one so a single bad image does not fail the whole batch
+                for item in items:
+                    try:
+                        self._infer([item])
+                    except Exception as e:
+                        item["error"] = f"inference: {e}"
+        for item in batch:
+            item.pop("person_image", None)
+            item.pop("garment_image", None)
+            written.put(item)
+
+    # Stage 3: write label maps and journal records
+
+    def _write(self, written):
+        while True:
+            item = written.get()
+            if item is _DONE:
+                return
+            start = time.perf_counter()
+            record = {"id": item["id"], "person": item["person"], "garment": item["garment"]}
+            try:
+                if "error" in item:
+                    record.update(status="error", error=item["error"])
+                elif item["selected_class"] is None:
+                    record.update(status="no_garment", message=item["result_text"])
+                else:
+                    label_map = filter_label_map(item["label_map"], item["selected_class"])
+                    path = os.path.join(self.output_dir, "label_maps", f"{item['id']}.png")
+                    tmp_path = f"{path}.tmp"
+                    # Low compression: label maps are mostly runs, and the writers must keep up
+                    write_palette_png(label_map, tmp_path, compress_level=1)
+                    os.replace(tmp_path, path)
+                    record.update(
+                        status="ok", label_map=os.path.relpath(path, self.output_dir),
+                        size=[label_map.shape[1], label_map.shape[0]],
+                        selected_classes=item["selected_class"], segformer_idx=item["segformer_idx"],
+                        message=item["result_text"],
+                    )
+            except Exception as e:
+                record.update(status="error", error=f"write: {e}")
+            self.timer.add("write", time.perf_counter() - start)
+            self._append_journal(record)
+
+    def _append_journal(self, record):
+        with self._journal_lock:
+            with open(os.path.join(self.output_dir, JOURNAL_NAME), "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self.counts[record["status"]] += 1
+
+    def run(self, pairs, progress_every=100):
+        """Process the pairs and return a throughput report"""
+        done = read_journal(self.output_dir)
+        pending = [pair for pair in pairs if pair["id"] not in done]
+
+        todo = queue.Queue(self.queue_size)
+        decoded = queue.Queue(self.queue_size)
+        written = queue.Queue(self.queue_size)
+
+        def feed():
+            for pair in pending:
+                todo.put(pair)
+            for _ in range(self.decode_threads):
+                todo.put(_DONE)
+
+        threads = [threading.Thread(target=feed, name="bulk-feed", daemon=True)]
+        threads += [threading.Thread(target=self._decode, args=(todo, decoded), name=f"bulk-decode-{i}", daemon=True) for i in range(self.decode_threads)]
+        writers = [threading.Thread(target=self._write, args=(written,), name=f"bulk-write-{i}", daemon=True) for i in range(self.writer_threads)]
+
+        start = time.perf_counter()
+        for thread in threads + writers:
+            thread.start()
+
+        finished, processed, batches = [0], 0, 0
+        while True:
+            batch = self._next_batch(decoded, finished)
+            if not batch:
+                break
+            self._process_batch(batch, written)
+            processed += len(batch)
+            batches += 1
+            if progress_every and processed // progress_every > (processed - len(batch)) // progress_every:
+                elapsed = time.perf_counter() - start
+                print(f"{processed}/{len(pending)} pairs  {processed / elapsed:.1f} pairs/s", flush=True)
+
+        for _ in writers:
+            written.put(_DONE)
+        for thread in threads + writers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        return {
+            "pairs": len(pairs),
+            "skipped": len(pairs) - len(pending),
+            "processed": processed,
+            "batches": batches,
+            "counts": dict(self.counts),
+            "seconds": elapsed,
+            "pairs_per_s": processed / elapsed if elapsed else 0.0,
+            "stages": {
+                stage: {"busy_seconds": seconds, "items": self.timer.items[stage], "items_per_busy_s": self.timer.items[stage] / seconds if seconds else 0.0}
+                for stage, seconds in self.timer.seconds.items()
+            },
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment person/garment pairs in bulk")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir", help="Directory with persons/ and garments/ subdirectories paired by file name")
+    source.add_argument("--manifest", help="JSONL or CSV manifest with person, garment and optional id columns")
+    parser.add_argument("--output-dir", required=True, help="Where label maps, the journal and the report are written")
+    parser.add_argument("--batch-size", type=int, default=config.MAX_BATCH_SIZE)
+    parser.add_argument("--decode-threads", type=int, default=4)
+    parser.add_argument("--writer-threads", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=32, help="Capacity of each queue between stages")
+    parser.add_argument("--resolution", choices=["full", "logits"], default="full", help="Label maps at the image size or at the model resolution")
+    parser.add_argument("--report", help="Write the JSON throughput report to this path (default: <output-dir>/report.json)")
+    args = parser.parse_args()
+
+    pairs = pairs_from_directory(args.input_dir) if args.input_dir else pairs_from_manifest(args.manifest)
+    pipeline = BulkPipeline(args.output_dir, args.batch_size, args.decode_threads, args.writer_threads, args.queue_size, args.resolution)
+    report = pipeline.run(pairs)
+
+    with open(args.report or os.path.join(args.output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    counts = report["counts"]
+    print(f"{report['processed']} pairs in {report['seconds']:.1f} s ({report['pairs_per_s']:.2f} pairs/s), "
+          f"{report['skipped']} already done: {counts['ok']} ok, {counts['no_garment']} without a garment, {counts['error']} errors")
+    for stage, result in report["stages"].items():
+        print(f"  {stage:<10} {result['busy_seconds']:8.2f} s busy  {result['items_per_busy_s']:8.2f} items/s")
+
+if __name__ == "__main__":
+    main()
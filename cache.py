@@ -0,0 +1,268 @@
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+import metrics
+from segmentation import predict_class_label_map
+from classification import PROMPT_TEMPLATE, model_revision, get_segments_for_garment, get_segments_for_garments
+from constants import fashion_categories, fashion_clip_to_segformer, category_to_segment_mapping, garment_to_segments
+from models import get_segformer, get_clip
+
+def image_digest(image):
+    """Content hash of a decoded image (mode, size and pixel bytes)"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+class MemoryLRU:
+    """Thread-safe in-memory LRU bounded by the total size of its values in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskLRU:
+    """Directory of cache files bounded by total bytes, evicting the least recently used"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Mark as recently used
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        except OSError:
+            return  # The disk tier is best effort
+        with self._lock:
+            # An overwritten entry no longer counts towards the total
+            try:
+                previous_size = os.path.getsize(path)
+            except OSError:
+                previous_size = 0
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                return
+            self.bytes += len(data) - previous_size
+            if self.bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop the oldest files until the directory is back under 90% of its budget"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.bytes -= size
+            except OSError:
+                pass
+
+class ResultCache:
+    """Two-tier (memory, optional disk) cache with hit/miss counters"""
+
+    def __init__(self, name, encode, decode, sizeof, memory_bytes, directory=None, disk_bytes=0):
+        self.name = name
+        self._encode = encode
+        self._decode = decode
+        self._sizeof = sizeof
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskLRU(os.path.join(directory, name), disk_bytes) if directory else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        metrics.inc("garment_seg_cache_lookups_total", {"cache": self.name, "result": counter})
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                value = self._decode(data)
+                self.memory.put(key, value, self._sizeof(value))
+                self._count("disk_hits")
+                return value
+        self._count("misses")
+        return None
+
+    def put(self, key, value):
+        self.memory.put(key, value, self._sizeof(value))
+        if self.disk is not None:
+            self.disk.put(key, self._encode(value))
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.bytes,
+            "disk_bytes": self.disk.bytes if self.disk is not None else 0,
+        }
+
+def _encode_label_map(label_map):
+    buf = io.BytesIO()
+    np.save(buf, label_map, allow_pickle=False)
+    return buf.getvalue()
+
+def _decode_label_map(data):
+    label_map = np.load(io.BytesIO(data), allow_pickle=False)
+    label_map.setflags(write=False)
+    return label_map
+
+def _encode_garment(result):
+    return json.dumps(list(result)).encode("utf-8")
+
+def _decode_garment(data):
+    return tuple(json.loads(data.decode("utf-8")))
+
+# Garment classification results (get_segments_for_garment output) and person label maps
+garment_cache = ResultCache(
+    "garment", _encode_garment, _decode_garment, lambda result: len(_encode_garment(result)),
+    config.RESULT_CACHE_MEMORY_BYTES // 16, config.RESULT_CACHE_DIR, config.RESULT_CACHE_DISK_BYTES // 16,
+)
+label_map_cache = ResultCache(
+    "label_map", _encode_label_map, _decode_label_map, lambda label_map: label_map.nbytes,
+    config.RESULT_CACHE_MEMORY_BYTES, config.RESULT_CACHE_DIR, config.RESULT_CACHE_DISK_BYTES,
+)
+
+def _classify_garments(garment_images, digests):
+    """Classify garments missing from the cache, through the catalogue index when one is configured"""
+    if config.CATALOGUE_DIR:
+        from catalogue import get_catalogue  # catalogue.py builds on this module
+        return get_catalogue().get_segments_for_garments(garment_images, digests)
+    return get_segments_for_garments(garment_images)
+
+def _garment_settings_hash():
+    """Hash of everything besides the pixels a garment classification depends on"""
+    # The CLIP and SegFormer (fallback) weights, the category prompts and their mappings,
+    # and the catalogue, so the disk tier never serves results of older settings
+    prompts = [PROMPT_TEMPLATE.format(category=category) for category in fashion_categories]
+    settings = json.dumps([
+        model_revision(get_clip()[0]), model_revision(get_segformer()[1]),
+        prompts, fashion_clip_to_segformer, category_to_segment_mapping, garment_to_segments,
+        config.CATALOGUE_DIR, config.CATALOGUE_MATCH_THRESHOLD if config.CATALOGUE_DIR else None,
+    ], sort_keys=True)
+    return hashlib.blake2b(settings.encode("utf-8"), digest_size=8).hexdigest()
+
+def get_segments_for_garment_cached(garment_image):
+    """get_segments_for_garment, memoised on the decoded garment pixels and the classification settings"""
+    digest = image_digest(garment_image)
+    key = f"{digest}-{_garment_settings_hash()}"
+    result = garment_cache.get(key)
+    if result is None:
+        if config.CATALOGUE_DIR:
+            result = _classify_garments([garment_image], [digest])[0]
+        else:
+            result = get_segments_for_garment(garment_image)
+        garment_cache.put(key, result)
+    selected_class, segformer_idx, result_text = result
+    return (list(selected_class) if selected_class is not None else None), segformer_idx, result_text
+
+def get_segments_for_garments_cached(garment_images):
+    """get_segments_for_garments, classifying only the garments missing from the cache"""
+    digests = [image_digest(garment_image) for garment_image in garment_images]
+    settings_hash = _garment_settings_hash()
+    keys = [f"{digest}-{settings_hash}" for digest in digests]
+    results = [garment_cache.get(key) for key in keys]
+    
+    missing = [i for i, result in enumerate(results) if result is None]
+    fresh = _classify_garments([garment_images[i] for i in missing], [digests[i] for i in missing]) if missing else []
+    for i, result in zip(missing, fresh):
+        garment_cache.put(keys[i], result)
+        results[i] = result
+    
+    return [
+        ((list(selected_class) if selected_class is not None else None), segformer_idx, result_text)
+        for selected_class, segformer_idx, result_text in results
+    ]
+
+def predict_label_map_cached(image, resolution=None, output_size=None, selected_classes=None):
+    """predict_class_label_map, memoised on the decoded image pixels and the label map settings"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    # Keyed on the loaded weights, so the disk tier never serves label maps of older weights
+    settings = f"{model_revision(get_segformer()[1])}|{resolution}|{output_size}"
+    if config.SEGMENTATION_STRATEGY == "roi" and selected_classes:
+        # Coarse-to-fine label maps are refined around the selected classes only
+        settings += f"|roi|{sorted(selected_classes)}"
+    settings_hash = hashlib.blake2b(settings.encode("utf-8"), digest_size=8).hexdigest()
+    key = f"{image_digest(image)}-{settings_hash}"
+    
+    label_map = label_map_cache.get(key)
+    if label_map is None:
+        label_map = predict_class_label_map(image, selected_classes, resolution, output_size)
+        label_map.setflags(write=False)  # Shared between requests
+        label_map_cache.put(key, label_map)
+    return label_map
+
+def cache_stats():
+    """Hit/miss counters and sizes of the result caches"""
+    return {cache.name: cache.stats() for cache in (garment_cache, label_map_cache)}
@@ -0,0 +1,246 @@
+import os
+import json
+import argparse
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+import config
+from models import get_clip
+from metrics import time_stage, inc
+from cache import image_digest
+from classification import model_revision, embed_images, classify_embeddings, segments_from_clip_result
+
+# Garment catalogue index. A directory holds:
+#   embeddings.f16 - (rows, dim) float16 L2-normalised Fashion-CLIP image embeddings, memory-mapped
+#   items.jsonl    - one line per row: catalogue id, pixel digest and get_segments_for_garment result
+#   meta.json      - embedding size and the model revision the embeddings came from
+# New items are appended to both files, so the catalogue grows without a rebuild.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+class CatalogueIndex:
+    """Precomputed catalogue embeddings with exact-digest and cosine nearest-neighbour lookup"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.items = []
+        self.rows_by_digest = {}
+        self.dim = None
+        self.revision = None
+        self._embeddings = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json")) as f:
+                meta = json.load(f)
+            self.dim, self.revision = meta["dim"], meta["revision"]
+
+        sidecar_intact = True
+        if os.path.exists(self._path("items.jsonl")):
+            with open(self._path("items.jsonl")) as f:
+                for line in f:
+                    try:
+                        self.items.append(json.loads(line))
+                    except ValueError:
+                        sidecar_intact = False  # A line cut short by an interrupted append
+                        break
+        self._reconcile(sidecar_intact)
+        self._map_embeddings()
+        self.rows_by_digest = {item["digest"]: row for row, item in enumerate(self.items)}
+
+    def _reconcile(self, sidecar_intact=True):
+        """Cut both files back to the rows that have a complete embedding and a sidecar line"""
+        path = self._path("embeddings.f16")
+        rows = os.path.getsize(path) // (self.dim * 2) if self.dim is not None and os.path.exists(path) else 0
+        if len(self.items) > rows:
+            del self.items[rows:]
+            sidecar_intact = False
+
+        # Drop a partial trailing row and rows whose sidecar line was never written, so
+        # the next append lands on the row its item line describes
+        if os.path.exists(path) and self.dim is not None and os.path.getsize(path) != len(self.items) * self.dim * 2:
+            with open(path, "r+b") as f:
+                f.truncate(len(self.items) * self.dim * 2)
+        if not sidecar_intact:
+            with open(self._path("items.jsonl.tmp"), "w") as f:
+                for item in self.items:
+                    f.write(json.dumps(item) + "\n")
+            os.replace(self._path("items.jsonl.tmp"), self._path("items.jsonl"))
+
+    def _map_embeddings(self):
+        path = self._path("embeddings.f16")
+        if self.dim is None or not os.path.exists(path):
+            self._embeddings = None
+            return
+        rows = os.path.getsize(path) // (self.dim * 2)
+        self._embeddings = np.memmap(path, dtype=np.float16, mode="r", shape=(rows, self.dim)) if rows else None
+
+    def __len__(self):
+        return len(self.items)
+
+    def check_model(self):
+        """Raise when the index was built with different weights than the loaded CLIP model"""
+        revision = model_revision(get_clip()[0])
+        if self.revision is not None and self.revision != revision:
+            raise ValueError(f"Catalogue {self.directory} was built with {self.revision}, the loaded model is {revision}")
+        return revision
+
+    def add(self, ids, images, batch_size=32):
+        """Embed and classify new catalogue items, skipping ids and images already indexed"""
+        revision = self.check_model()
+        known_ids = {item["id"] for item in self.items}
+        added = 0
+        for start in range(0, len(images), batch_size):
+            batch = [
+                (item_id, image, image_digest(image))
+                for item_id, image in zip(ids[start:start + batch_size], images[start:start + batch_size])
+                if item_id not in known_ids
+            ]
+            batch = [(item_id, image, digest) for item_id, image, digest in batch if digest not in self.rows_by_digest]
+            if not batch:
+                continue
+
+            # One CLIP pass gives both the stored embedding and the classification
+            embeds = embed_images([image for _, image, _ in batch])
+            results = [
+                segments_from_clip_result(image, clip_result)
+                for (_, image, _), clip_result in zip(batch, classify_embeddings(embeds))
+            ]
+            self._append(revision, embeds.numpy().astype(np.float16), [
+                {"id": item_id, "digest": digest, "result": list(result)}
+                for (item_id, _, digest), result in zip(batch, results)
+            ])
+            known_ids.update(item_id for item_id, _, _ in batch)
+            added += len(batch)
+        return added
+
+    def _append(self, revision, embeddings, items):
+        with self._lock:
+            if self.dim is None:
+                self.dim, self.revision = embeddings.shape[1], revision
+                with open(self._path("meta.json"), "w") as f:
+                    json.dump({"dim": self.dim, "revision": self.revision}, f)
+
+            # Embeddings first, so an interrupted append leaves at worst an embedding row
+            # without its sidecar line, which _reconcile truncates away on the next load
+            with open(self._path("embeddings.f16"), "ab") as f:
+                f.write(np.ascontiguousarray(embeddings).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._path("items.jsonl"), "a") as f:
+                for item in items:
+                    f.write(json.dumps(item) + "\n")
+
+            for item in items:
+                self.rows_by_digest[item["digest"]] = len(self.items)
+                self.items.append(item)
+            self._map_embeddings()
+
+    def search(self, query_embeds, k=1, chunk_rows=None):
+        """Cosine top-k over the catalogue, scoring chunk_rows rows at a time; returns (scores, rows)"""
+        query = np.asarray(query_embeds, dtype=np.float32)
+        scores = np.full((len(query), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(query), k), -1, dtype=np.int64)
+        embeddings = self._embeddings
+        if embeddings is None or not len(query):
+            return scores, rows
+
+        chunk_rows = chunk_rows or config.CATALOGUE_CHUNK_ROWS
+        for start in range(0, len(embeddings), chunk_rows):
+            chunk = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float32)
+            # Merge this chunk's scores with the running top-k
+            candidate_scores = np.concatenate([scores, query @ chunk.T], axis=1)
+            candidate_rows = np.concatenate([rows, np.broadcast_to(np.arange(start, start + len(chunk)), (len(query), len(chunk)))], axis=1)
+            top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(candidate_scores, top, axis=1)
+            rows = np.take_along_axis(candidate_rows, top, axis=1)
+
+        order = np.argsort(-scores, axis=1)
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+    def get_segments_for_garments(self, garment_images, digests=None, threshold=None):
+        """get_segments_for_garments, answered from the catalogue where possible"""
+        threshold = config.CATALOGUE_MATCH_THRESHOLD if threshold is None else threshold
+        digests = digests or [image_digest(image) for image in garment_images]
+        results = [None] * len(garment_images)
+
+        # Exact match on the decoded pixels
+        for i, digest in enumerate(digests):
+            row = self.rows_by_digest.get(digest)
+            if row is not None:
+                results[i] = tuple(self.items[row]["result"])
+                inc("garment_seg_classifications_total", {"method": "catalogue_exact"})
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+
+        # Nearest catalogue neighbour of the rest, then full classification of the misses
+        # from the same embeddings
+        embeds = embed_images([garment_images[i] for i in missing])
+        with time_stage("catalogue_search"):
+            scores, rows = self.search(embeds.numpy(), k=1)
+        unmatched = []
+        for j, i in enumerate(missing):
+            if scores[j, 0] >= threshold:
+                item = self.items[rows[j, 0]]
+                selected_class, segformer_idx, result_text = item["result"]
+                results[i] = (selected_class, segformer_idx, f"{result_text}\nCatalogue match: {item['id']} (similarity {scores[j, 0]:.3f})")
+                inc("garment_seg_classifications_total", {"method": "catalogue_nearest"})
+            else:
+                unmatched.append(j)
+
+        if unmatched:
+            clip_results = classify_embeddings(embeds[torch.tensor(unmatched)])
+            for j, clip_result in zip(unmatched, clip_results):
+                results[missing[j]] = segments_from_clip_result(garment_images[missing[j]], clip_result)
+        return results
+
+# Index loaded from config.CATALOGUE_DIR
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+def get_catalogue():
+    """Return the catalogue index of config.CATALOGUE_DIR, loading it on first use"""
+    global _catalogue
+    with _catalogue_lock:
+        if _catalogue is None or _catalogue.directory != config.CATALOGUE_DIR:
+            catalogue = CatalogueIndex(config.CATALOGUE_DIR)
+            catalogue.check_model()
+            _catalogue = catalogue
+        return _catalogue
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or extend the garment catalogue index")
+    parser.add_argument("images", help="Directory of catalogue garment images; the file name (without extension) is the item id")
+    parser.add_argument("--catalogue-dir", default=config.CATALOGUE_DIR, help="Index directory (default: GARMENT_SEG_CATALOGUE_DIR)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+    if not args.catalogue_dir:
+        parser.error("--catalogue-dir is required unless GARMENT_SEG_CATALOGUE_DIR is set")
+
+    index = CatalogueIndex(args.catalogue_dir)
+    names = sorted(name for name in os.listdir(args.images) if name.lower().endswith(IMAGE_EXTENSIONS))
+    known_ids = {item["id"] for item in index.items}
+    names = [name for name in names if os.path.splitext(name)[0] not in known_ids]
+
+    # Decode one batch at a time so the catalogue never has to fit in memory
+    added = 0
+    for start in range(0, len(names), args.batch_size):
+        batch = names[start:start + args.batch_size]
+        images = [Image.open(os.path.join(args.images, name)).convert("RGB") for name in batch]
+        added += index.add([os.path.splitext(name)[0] for name in batch], images, args.batch_size)
+        print(f"{start + len(batch)}/{len(names)} new images, {len(index)} items indexed", flush=True)
+    print(f"Added {added} items, the catalogue has {len(index)}")
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,162 @@
+import os
+import re
+import json
+import hashlib
+import threading
 import torch
-from models import clip_model, clip_processor, segformer_model, segformer_processor
+import config
+from models import get_clip
+from backends import projected_features, weights_revision
+from batching import get_batcher
+from metrics import time_stage, inc
 from constants import fashion_categories, fashion_clip_to_segformer, class_names, category_to_segment_mapping, garment_to_segments
 from segmentation import identify_garment_segformer
+from preprocessing import clip_pixel_values
 
-def identify_garment_clip(image):
-    """Identify the garment type using Fashion-CLIP model"""
-    # Prepare text prompts
-    texts = [f"a photo of a {category}" for category in fashion_categories]
+# Prompt template used to turn a category into a CLIP text query
+PROMPT_TEMPLATE = "a photo of a {category}"
+
+# In-memory text embedding matrices, keyed by model revision and prompt hash
+_text_embeddings = {}
+_text_embeddings_lock = threading.Lock()
+
+def model_revision(model):
+    """Identify the loaded weights and backend, for keys of anything derived from the model"""
+    revision = weights_revision(model) or getattr(model.config, "_name_or_path", "") or "unknown"
+    revision = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(revision)).strip("_")
+    backend = getattr(model, "backend", "fp32")
+    if backend != "fp32":
+        revision = f"{revision}-{backend}"
+    return revision
+
+def _text_embedding_key(model, prompts):
+    """Build the cache key for a model and a list of prompts"""
+    revision = model_revision(model)
+    prompts_hash = hashlib.sha256(json.dumps(prompts).encode("utf-8")).hexdigest()[:16]
+    return f"{revision}-{prompts_hash}"
+
+def _compute_text_embeddings(prompts):
+    """Run the CLIP text tower once over all prompts"""
+    clip_model, clip_processor = get_clip()
+    inputs = clip_processor(text=prompts, return_tensors="pt", padding=True)
+    with time_stage("clip_text_tower"), torch.no_grad():
+        text_embeds = projected_features(clip_model.get_text_features(**inputs)).float()
+    return text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+
+def get_text_embeddings(categories=fashion_categories):
+    """Return the L2-normalised text embedding matrix for the given categories"""
+    clip_model, _ = get_clip()
+    prompts = [PROMPT_TEMPLATE.format(category=category) for category in categories]
+    key = _text_embedding_key(clip_model, prompts)
+    
+    with _text_embeddings_lock:
+        if key in _text_embeddings:
+            return _text_embeddings[key]
+        
+        path = os.path.join(config.CACHE_DIR, f"clip_text_embeddings_{key}.pt")
+        text_embeds = None
+        
+        # Reuse the matrix persisted by a previous process if it is usable
+        if config.PERSIST_TEXT_EMBEDDINGS and os.path.exists(path):
+            try:
+                text_embeds = torch.load(path, map_location="cpu")
+                if text_embeds.shape[0] != len(prompts):
+                    text_embeds = None
+            except Exception:
+                text_embeds = None
+        
+        if text_embeds is None:
+            text_embeds = _compute_text_embeddings(prompts)
+            if config.PERSIST_TEXT_EMBEDDINGS:
+                try:
+                    os.makedirs(config.CACHE_DIR, exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    torch.save(text_embeds, tmp_path)
+                    os.replace(tmp_path, path)
+                except OSError:
+                    pass  # The cache is an optimisation, never a requirement
+        
+        _text_embeddings[key] = text_embeds
+        return text_embeds
+
+def embed_images(images):
+    """Return L2-normalised Fashion-CLIP image embeddings for a batch of images"""
+    clip_model, clip_processor = get_clip()
     
     # Process inputs
-    inputs = clip_processor(text=texts, images=image, return_tensors="pt", padding=True)
+    with time_stage("clip_preprocess"):
+        if config.PREPROCESSING == "tensor":
+            inputs = {"pixel_values": clip_pixel_values(images, clip_processor)}
+        else:
+            inputs = clip_processor(images=list(images), return_tensors="pt")
     
-    # Get predictions
+    # Only the image tower runs per request
+    with time_stage("clip_image_tower"), torch.no_grad():
+        image_embeds = projected_features(clip_model.get_image_features(**inputs)).float()
+    return image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+
+def classify_embeddings(image_embeds):
+    """Match image embeddings against the category prompts"""
+    clip_model, _ = get_clip()
+    
+    # The category prompts never change, so their embeddings are precomputed
+    text_embeds = get_text_embeddings()
+    
+    # Get predictions with a single matmul against the cached matrix
     with torch.no_grad():
-        outputs = clip_model(**inputs)
-        logits_per_image = outputs.logits_per_image
+        logits_per_image = clip_model.logit_scale.exp().float() * image_embeds @ text_embeds.t()
         probs = logits_per_image.softmax(dim=1)
     
-    # Get the top prediction
-    top_idx = torch.argmax(probs[0]).item()
-    top_category = fashion_categories[top_idx]
-    confidence = probs[0][top_idx].item() * 100
+    results = []
+    for image_probs in probs:
+        # Get the top prediction
+        top_idx = torch.argmax(image_probs).item()
+        top_category = fashion_categories[top_idx]
+        confidence = image_probs[top_idx].item() * 100
+        
+        # Map to SegFormer class if possible, otherwise fall back to using SegFormer directly
+        segformer_idx = fashion_clip_to_segformer.get(top_category)
+        results.append((top_category, segformer_idx, confidence))
     
-    # Map to SegFormer class if possible
-    if top_category in fashion_clip_to_segformer:
-        segformer_idx = fashion_clip_to_segformer[top_category]
-        segformer_class = class_names[segformer_idx]
-        return top_category, segformer_idx, confidence
-    else:
-        # Fallback to using SegFormer directly
-        return top_category, None, confidence
+    return results
+
+def identify_garments_clip(images):
+    """Identify the garment type of a batch of images in one Fashion-CLIP forward pass"""
+    return classify_embeddings(embed_images(images))
+
+def identify_garment_clip(image):
+    """Identify the garment type using Fashion-CLIP model"""
+    if config.MICRO_BATCHING:
+        # Share the forward pass with concurrent requests
+        return get_batcher("clip", identify_garments_clip)(image)
+    return identify_garments_clip([image])[0]
 
 def get_segments_for_garment(garment_image):
     """Get the segments that should be included for a given garment image"""
     # First try to identify the garment using Fashion-CLIP
-    clip_category, segformer_idx, confidence = identify_garment_clip(garment_image)
+    return segments_from_clip_result(garment_image, identify_garment_clip(garment_image))
+
+def get_segments_for_garments(garment_images):
+    """Get the segments for several garment images, classifying them in one Fashion-CLIP pass"""
+    clip_results = identify_garments_clip(garment_images) if garment_images else []
+    return [
+        segments_from_clip_result(garment_image, clip_result)
+        for garment_image, clip_result in zip(garment_images, clip_results)
+    ]
+
+def segments_from_clip_result(garment_image, clip_result):
+    """Turn a Fashion-CLIP (category, segformer_idx, confidence) result into the segments to include"""
+    clip_category, segformer_idx, confidence = clip_result
     
     # If CLIP couldn't map to a SegFormer class, fall back to SegFormer
     if segformer_idx is None:
-        garment_name, segformer_idx = identify_garment_segformer(garment_image)
+        inc("garment_seg_classifications_total", {"method": "segformer_fallback"})
+        with time_stage("segformer_fallback"):
+            garment_name, segformer_idx = identify_garment_segformer(garment_image)
         method = "SegFormer (fallback)"
         confidence_text = ""
     else:
+        inc("garment_seg_classifications_total", {"method": "fashion_clip"})
         garment_name = class_names[segformer_idx]
         method = "Fashion-CLIP"
         confidence_text = f" with {confidence:.2f}% confidence"
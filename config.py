@@ -0,0 +1,143 @@
+import os
+
+# Runtime settings, overridable through environment variables
+
+def _env_bool(name, default):
+    """Read a boolean flag from the environment"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def _env_int(name, default):
+    """Read an integer setting from the environment"""
+    value = os.environ.get(name)
+    return default if value in (None, "") else int(value)
+
+def _env_float(name, default):
+    """Read a float setting from the environment"""
+    value = os.environ.get(name)
+    return default if value in (None, "") else float(value)
+
+# Directory for on-disk caches (precomputed text embeddings, ...)
+CACHE_DIR = os.environ.get(
+    "GARMENT_SEG_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "garment_segmentation"),
+)
+
+# Persist the Fashion-CLIP category text embeddings to CACHE_DIR
+PERSIST_TEXT_EMBEDDINGS = _env_bool("GARMENT_SEG_PERSIST_TEXT_EMBEDDINGS", True)
+
+# Model sources: a hub id or a local snapshot directory (loaded offline, memory-mapped)
+SEGFORMER_MODEL = os.environ.get("GARMENT_SEG_SEGFORMER_MODEL", "mattmdjaga/segformer_b2_clothes")
+CLIP_MODEL = os.environ.get("GARMENT_SEG_CLIP_MODEL", "patrickjohncyh/fashion-clip")
+
+# Inference backend of each model: "fp32", "bf16", "int8" or "onnx"
+SEGFORMER_BACKEND = os.environ.get("GARMENT_SEG_SEGFORMER_BACKEND", "fp32")
+CLIP_BACKEND = os.environ.get("GARMENT_SEG_CLIP_BACKEND", "fp32")
+
+# Directory holding exported ONNX graphs
+ONNX_DIR = os.environ.get("GARMENT_SEG_ONNX_DIR", os.path.join(CACHE_DIR, "onnx"))
+
+# Image preprocessing: "hf" (the Hugging Face processors) or "tensor" (preprocessing.py:
+# one uint8 tensor per image shared by both models, vectorised resize and normalise)
+PREPROCESSING = os.environ.get("GARMENT_SEG_PREPROCESSING", "hf")
+
+# Load the models and run a dummy forward pass at startup instead of on first request
+WARMUP_MODELS = _env_bool("GARMENT_SEG_WARMUP_MODELS", False)
+
+# Route single-image requests through a background micro-batcher
+MICRO_BATCHING = _env_bool("GARMENT_SEG_MICRO_BATCHING", False)
+MAX_BATCH_SIZE = _env_int("GARMENT_SEG_MAX_BATCH_SIZE", 8)
+MAX_BATCH_WAIT_MS = _env_float("GARMENT_SEG_MAX_BATCH_WAIT_MS", 10.0)
+
+# Resolution of the SegFormer label map: "full" (exact, tiled), "display" or "logits"
+SEGMENTATION_RESOLUTION = os.environ.get("GARMENT_SEG_SEGMENTATION_RESOLUTION", "full")
+
+# Output rows upsampled per tile in "full" mode, bounding peak memory
+SEGMENTATION_TILE_ROWS = _env_int("GARMENT_SEG_SEGMENTATION_TILE_ROWS", 128)
+
+# "single": one SegFormer pass over the whole image; "roi": a coarse pass locates the
+# selected classes and a second pass refines only that region
+SEGMENTATION_STRATEGY = os.environ.get("GARMENT_SEG_SEGMENTATION_STRATEGY", "single")
+
+# Square input size of the coarse pass, margin added around the located region (as a
+# fraction of its size) and region area, as a fraction of the image, above which the
+# whole image is segmented in a single pass instead
+ROI_COARSE_SIZE = _env_int("GARMENT_SEG_ROI_COARSE_SIZE", 256)
+ROI_MARGIN = _env_float("GARMENT_SEG_ROI_MARGIN", 0.15)
+ROI_MAX_AREA = _env_float("GARMENT_SEG_ROI_MAX_AREA", 0.5)
+
+# Number of distinct legend images kept in memory
+LEGEND_CACHE_SIZE = _env_int("GARMENT_SEG_LEGEND_CACHE_SIZE", 128)
+
+# Webcam / video streaming: a frame is re-segmented when its mean absolute difference
+# (0-255) from the last segmented frame, both downscaled to STREAM_DIFF_SIZE pixels square,
+# exceeds STREAM_DIFF_THRESHOLD; the label map resolution used for streams; and the
+# seconds between frames sent by the webcam
+STREAM_DIFF_THRESHOLD = _env_float("GARMENT_SEG_STREAM_DIFF_THRESHOLD", 4.0)
+STREAM_DIFF_SIZE = _env_int("GARMENT_SEG_STREAM_DIFF_SIZE", 64)
+STREAM_RESOLUTION = os.environ.get("GARMENT_SEG_STREAM_RESOLUTION", "display")
+STREAM_INTERVAL = _env_float("GARMENT_SEG_STREAM_INTERVAL", 0.1)
+
+# Content-addressed result cache: in-memory budget in bytes (0 disables it) and an
+# optional on-disk tier with its own budget
+RESULT_CACHE_MEMORY_BYTES = _env_int("GARMENT_SEG_RESULT_CACHE_MEMORY_BYTES", 256 * 1024 * 1024)
+RESULT_CACHE_DIR = os.environ.get("GARMENT_SEG_RESULT_CACHE_DIR") or None
+RESULT_CACHE_DISK_BYTES = _env_int("GARMENT_SEG_RESULT_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024)
+
+# Garment catalogue index (see catalogue.py): a directory of precomputed Fashion-CLIP
+# embeddings consulted before classifying a garment (unset disables it), the cosine
+# similarity a nearest neighbour needs to count as a match, and rows scored per chunk
+CATALOGUE_DIR = os.environ.get("GARMENT_SEG_CATALOGUE_DIR") or None
+CATALOGUE_MATCH_THRESHOLD = _env_float("GARMENT_SEG_CATALOGUE_MATCH_THRESHOLD", 0.95)
+CATALOGUE_CHUNK_ROWS = _env_int("GARMENT_SEG_CATALOGUE_CHUNK_ROWS", 65536)
+
+# Headless HTTP service (service.py): bind address and the largest accepted image body
+SERVICE_HOST = os.environ.get("GARMENT_SEG_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = _env_int("GARMENT_SEG_SERVICE_PORT", 8000)
+SERVICE_MAX_BYTES = _env_int("GARMENT_SEG_SERVICE_MAX_BYTES", 20 * 1024 * 1024)
+
+# Memory budget guard (memory.py): estimated peak bytes all in-flight requests of a
+# process may use (0 disables it), what to do with a request that does not fit right now
+# ("downscale" the image or "queue" until memory frees up), and how long a request may wait
+MEMORY_BUDGET_BYTES = _env_int("GARMENT_SEG_MEMORY_BUDGET_BYTES", 0)
+MEMORY_POLICY = os.environ.get("GARMENT_SEG_MEMORY_POLICY", "downscale")
+MEMORY_QUEUE_TIMEOUT = _env_float("GARMENT_SEG_MEMORY_QUEUE_TIMEOUT", 30.0)
+
+# Fixed per-request cost of a SegFormer forward pass (weights excluded) used by the estimate
+MEMORY_INFERENCE_BYTES = _env_int("GARMENT_SEG_MEMORY_INFERENCE_BYTES", 192 * 1024 * 1024)
+
+# Record the peak traced allocation of every pipeline stage (see metrics.stage_peaks)
+MEMORY_TRACKING = _env_bool("GARMENT_SEG_MEMORY_TRACKING", False)
+
+# Prometheus metrics endpoint served next to the app (0 disables it); collection is
+# also switched on by GARMENT_SEG_METRICS=1 without serving
+METRICS_PORT = _env_int("GARMENT_SEG_METRICS_PORT", 0)
+METRICS_HOST = os.environ.get("GARMENT_SEG_METRICS_HOST", "127.0.0.1")
+METRICS_ENABLED = _env_bool("GARMENT_SEG_METRICS", METRICS_PORT > 0)
+
+# torch intra-op threads for in-process inference (0 keeps torch's default)
+TORCH_THREADS = _env_int("GARMENT_SEG_TORCH_THREADS", 0)
+
+# Process pool in front of process_person_and_garment (0 runs requests in the app's threads):
+# threads per worker (0 splits the cores evenly), pending request bound (0 means 2 per
+# worker) and how long a request waits for a queue slot before being rejected
+WORKER_PROCESSES = _env_int("GARMENT_SEG_WORKER_PROCESSES", 0)
+WORKER_THREADS = _env_int("GARMENT_SEG_WORKER_THREADS", 0)
+WORKER_MAX_PENDING = _env_int("GARMENT_SEG_WORKER_MAX_PENDING", 0)
+WORKER_QUEUE_TIMEOUT = _env_float("GARMENT_SEG_WORKER_QUEUE_TIMEOUT", 5.0)
+
+# Gradio request queue: events of each handler run at once (Gradio's default is 1) and
+# requests waiting in the queue before new ones are turned away (0: unbounded)
+APP_CONCURRENCY_LIMIT = _env_int("GARMENT_SEG_APP_CONCURRENCY_LIMIT", 1)
+APP_QUEUE_MAX_SIZE = _env_int("GARMENT_SEG_APP_QUEUE_MAX_SIZE", 0)
+
+# Image fetching for URLs: pooled connections, retries, timeouts (seconds), a download
+# byte budget, and the size images are decoded near (JPEG draft mode / reduce on decode)
+FETCH_POOL_SIZE = _env_int("GARMENT_SEG_FETCH_POOL_SIZE", 16)
+FETCH_RETRIES = _env_int("GARMENT_SEG_FETCH_RETRIES", 2)
+FETCH_CONNECT_TIMEOUT = _env_float("GARMENT_SEG_FETCH_CONNECT_TIMEOUT", 3.05)
+FETCH_READ_TIMEOUT = _env_float("GARMENT_SEG_FETCH_READ_TIMEOUT", 10.0)
+FETCH_MAX_BYTES = _env_int("GARMENT_SEG_FETCH_MAX_BYTES", 20 * 1024 * 1024)
+FETCH_TARGET_SIZE = tuple(int(side) for side in os.environ.get("GARMENT_SEG_FETCH_TARGET_SIZE", "512x512").lower().split("x"))
@@ -0,0 +1,143 @@
+import os
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+import config
+from backends import BACKENDS, projected_features, wrap_segformer, wrap_clip
+from models import load_segformer_model, load_clip_model
+from constants import fashion_categories
+from classification import PROMPT_TEMPLATE
+from segmentation import logits_to_label_map
+
+# Export / quantise every backend and check it agrees with the fp32 reference:
+# label-map pixel agreement for SegFormer, top-1 category agreement for CLIP.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+def load_samples(directory, limit=None):
+    """Load the sample images of a directory, sorted by name"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names[:limit]]
+
+def random_samples(count, seed=0):
+    """Random images for offline smoke runs"""
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 256, (320, 240, 3), dtype=np.uint8)) for _ in range(count)]
+
+def _label_maps(processor, model, images):
+    label_maps, seconds = [], 0.0
+    for image in images:
+        inputs = processor(images=image, return_tensors="pt")
+        start = time.perf_counter()
+        with torch.no_grad():
+            logits = model(**inputs).logits[0].float()
+        seconds += time.perf_counter() - start
+        label_maps.append(logits_to_label_map(logits, image.size, "full"))
+    return label_maps, seconds / len(images)
+
+def _top1(model, processor, images):
+    prompts = [PROMPT_TEMPLATE.format(category=category) for category in fashion_categories]
+    text_inputs = processor(text=prompts, return_tensors="pt", padding=True)
+    predictions, seconds = [], 0.0
+    with torch.no_grad():
+        text_embeds = projected_features(model.get_text_features(**text_inputs)).float()
+        text_embeds = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+        for image in images:
+            inputs = processor(images=image, return_tensors="pt")
+            start = time.perf_counter()
+            image_embeds = projected_features(model.get_image_features(**inputs)).float()
+            seconds += time.perf_counter() - start
+            predictions.append(int((image_embeds @ text_embeds.t()).argmax()))
+    return predictions, seconds / len(images)
+
+def check_segformer(processor, model, images, backends, source):
+    """Pixel agreement of each backend's label maps with the fp32 reference"""
+    reference, reference_seconds = _label_maps(processor, model, images)
+    report = {"fp32": {"pixel_agreement": 1.0, "min_pixel_agreement": 1.0, "forward_ms": reference_seconds * 1000}}
+    for backend in backends:
+        # Always export afresh, so the check never runs against a graph of older weights
+        candidate = wrap_segformer(copy.deepcopy(model), backend, source, reexport=True)
+        label_maps, seconds = _label_maps(processor, candidate, images)
+        agreements = [float((a == b).mean()) for a, b in zip(reference, label_maps)]
+        report[backend] = {
+            "pixel_agreement": float(np.mean(agreements)),
+            "min_pixel_agreement": float(np.min(agreements)),
+            "forward_ms": seconds * 1000,
+        }
+    return report
+
+def check_clip(model, processor, images, backends, source):
+    """Top-1 agreement of each backend's classifications with the fp32 reference"""
+    reference, reference_seconds = _top1(model, processor, images)
+    report = {"fp32": {"top1_agreement": 1.0, "image_tower_ms": reference_seconds * 1000}}
+    for backend in backends:
+        candidate = wrap_clip(copy.deepcopy(model), backend, source, reexport=True)
+        predictions, seconds = _top1(candidate, processor, images)
+        report[backend] = {
+            "top1_agreement": float(np.mean([a == b for a, b in zip(reference, predictions)])),
+            "image_tower_ms": seconds * 1000,
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Export/quantise the inference backends and check agreement with fp32")
+    parser.add_argument("--backends", nargs="+", default=[b for b in BACKENDS if b != "fp32"], choices=BACKENDS)
+    parser.add_argument("--samples", help="Directory of sample images (person and garment photos)")
+    parser.add_argument("--limit", type=int, help="Use at most this many samples")
+    parser.add_argument("--tiny", action="store_true", help="Use tiny random-weight models and random images (offline smoke run)")
+    parser.add_argument("--min-pixel-agreement", type=float, default=0.98)
+    parser.add_argument("--min-top1-agreement", type=float, default=0.95)
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args()
+
+    # Load the fp32 references; each backend is built from a copy of them
+    if args.tiny:
+        from tiny_models import build_tiny_segformer, build_tiny_clip
+        segformer_processor, segformer_model = build_tiny_segformer()
+        clip_model, clip_processor = build_tiny_clip()
+        segformer_source, clip_source = "tiny-random-segformer", "tiny-random-clip"
+    else:
+        segformer_processor, segformer_model = load_segformer_model(backend="fp32")
+        clip_model, clip_processor = load_clip_model(backend="fp32")
+        segformer_source, clip_source = config.SEGFORMER_MODEL, config.CLIP_MODEL
+
+    if args.samples:
+        images = load_samples(args.samples, args.limit)
+    elif args.tiny:
+        images = random_samples(args.limit or 8)
+    else:
+        parser.error("--samples is required unless --tiny is given")
+
+    backends = [backend for backend in args.backends if backend != "fp32"]
+    report = {
+        "samples": len(images),
+        "segformer": check_segformer(segformer_processor, segformer_model, images, backends, segformer_source),
+        "clip": check_clip(clip_model, clip_processor, images, backends, clip_source),
+    }
+
+    failures = []
+    for backend, result in report["segformer"].items():
+        print(f"segformer {backend:<5} pixel agreement {result['pixel_agreement']:.4f} (min {result['min_pixel_agreement']:.4f})  forward {result['forward_ms']:8.2f} ms")
+        if result["min_pixel_agreement"] < args.min_pixel_agreement:
+            failures.append(f"segformer/{backend}")
+    for backend, result in report["clip"].items():
+        print(f"clip      {backend:<5} top-1 agreement {result['top1_agreement']:.4f}  image tower {result['image_tower_ms']:8.2f} ms")
+        if result["top1_agreement"] < args.min_top1_agreement:
+            failures.append(f"clip/{backend}")
+    report["failures"] = failures
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        print(f"Below the agreement thresholds: {', '.join(failures)}")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
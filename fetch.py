@@ -0,0 +1,101 @@
+import io
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+import config
+
+class ImageTooLargeError(ValueError):
+    """Raised when a download exceeds the byte budget"""
+
+# Pooled session and fetch threads, shared by the whole process
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+def get_session():
+    """Return the process-wide HTTP session with connection pooling and retries"""
+    global _session
+    with _lock:
+        if _session is None:
+            retries = Retry(total=config.FETCH_RETRIES, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+            adapter = HTTPAdapter(pool_connections=config.FETCH_POOL_SIZE, pool_maxsize=config.FETCH_POOL_SIZE, max_retries=retries)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(config.FETCH_POOL_SIZE, thread_name_prefix="fetch")
+        return _executor
+
+def fetch_bytes(url, max_bytes=None, timeout=None):
+    """Download url, aborting as soon as the body exceeds max_bytes"""
+    max_bytes = max_bytes or config.FETCH_MAX_BYTES
+    timeout = timeout or (config.FETCH_CONNECT_TIMEOUT, config.FETCH_READ_TIMEOUT)
+
+    with get_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+
+        # Reject early when the server announces an oversized body
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ImageTooLargeError(f"Image is {int(length)} bytes, the limit is {max_bytes}")
+
+        chunks, total = [], 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            total += len(chunk)
+            if total > max_bytes:
+                raise ImageTooLargeError(f"Image exceeds the {max_bytes} byte limit")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+def decode_image(data, target_size=None):
+    """Decode image bytes at the smallest scale that still covers target_size=(width, height)"""
+    target_size = target_size or config.FETCH_TARGET_SIZE
+    image = Image.open(io.BytesIO(data))
+
+    if target_size:
+        # JPEG decodes directly at 1/2, 1/4 or 1/8 scale (no-op for other formats)
+        image.draft("RGB", target_size)
+
+        # Other formats are reduced by an integer factor right after decoding
+        factor = min(image.width // target_size[0], image.height // target_size[1])
+        if factor >= 2 and image.format != "JPEG":
+            # reduce() rejects palette, 1-bit and 16-bit images, so those are converted first
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image = image.reduce(factor)
+
+    return image.convert("RGB")
+
+def fetch_image(url, target_size=None, max_bytes=None):
+    """Download and decode an image near target_size"""
+    return decode_image(fetch_bytes(url, max_bytes), target_size)
+
+async def fetch_images_async(urls, target_size=None, max_bytes=None):
+    """Fetch several images concurrently; failed fetches are returned as exceptions"""
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    tasks = [loop.run_in_executor(executor, fetch_image, url, target_size, max_bytes) for url in urls]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+def fetch_images(urls, target_size=None, max_bytes=None):
+    """Blocking version of fetch_images_async"""
+    futures = [_get_executor().submit(fetch_image, url, target_size, max_bytes) for url in urls]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
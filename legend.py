@@ -0,0 +1,61 @@
+import io
+from functools import lru_cache
+
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+import config
+from constants import class_names, color_map, category_to_segment_mapping, garment_to_segments
+
+# Legend colours per class, as RGB floats
+DEFAULT_PALETTE = tuple(tuple(color_map(i)[:3]) for i in range(len(class_names)))
+
+def _legend_key(selected_classes):
+    """Normalise a class selection to the (ordered) classes the legend shows"""
+    if not selected_classes:
+        return None
+    selected = set(selected_classes)
+    return tuple(name for name in class_names if name in selected)
+
+@lru_cache(maxsize=config.LEGEND_CACHE_SIZE)
+def _cached_legend(key, palette):
+    """Render a legend with a standalone figure (no pyplot global state)"""
+    fig = Figure(figsize=(10, 2))
+    FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0.0)
+    ax = fig.add_subplot()
+    ax.axis('off')
+    
+    # Create legend patches
+    legend_elements = []
+    for i, class_name in enumerate(class_names):
+        if i == 0 and key is not None:  # Skip background in legend if filtering
+            continue
+        if key is None or class_name in key:
+            legend_elements.append(Rectangle((0, 0), 1, 1, color=palette[i]))
+    
+    # Only add legend if there are elements to show
+    if legend_elements:
+        legend_class_names = [name for name in class_names if name != "Background" and (key is None or name in key)]
+        ax.legend(legend_elements, legend_class_names, loc='center', ncol=6)
+    
+    # Save the legend to a bytes buffer
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight', transparent=True)
+    buf.seek(0)
+    legend_img = Image.open(buf)
+    legend_img.load()
+    return legend_img
+
+def render_legend(selected_classes=None, palette=None):
+    """Return the legend image for a class selection, rendered once per selection and palette"""
+    return _cached_legend(_legend_key(selected_classes), palette or DEFAULT_PALETTE).copy()
+
+def prerender_legends():
+    """Render the legend of every known garment mapping ahead of the first request"""
+    selections = list(category_to_segment_mapping.values())
+    selections += [[class_names[idx] for idx in indices] for indices in garment_to_segments.values()]
+    for selection in selections:
+        render_legend(selection)
@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import transformers
+from PIL import Image, ImageDraw
+
+import config
+from tiny_models import install_tiny_models
+from benchmark import _parse_size, _max_rss_bytes
+
+# End-to-end load test of process_person_and_garment with tiny random-weight models.
+# Requests run in-process on a thread pool, or against the Gradio app over localhost
+# through gradio_client (either an app launched here or an already running one), at each
+# concurrency level of a ramp. Every level reports throughput, latency percentiles,
+# error rate and peak RSS.
+
+DEFAULT_SIZES = [(512, 768), (1024, 1536), (2048, 3072)]
+DEFAULT_CONCURRENCY = [1, 2, 4, 8]
+
+FIXED_SIZE = (400, 400)
+
+# Messages the handlers return instead of results
+ERROR_PREFIXES = ("Error", "Please provide", "The server is busy")
+
+def _synthetic_image(size, seed, shapes=12):
+    """A smooth synthetic photo of size=(width, height): a gradient with random coloured shapes"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    # Vertical gradient between two random colours
+    top, bottom = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0.0, 1.0, height)[:, None]
+    column = (top * (1 - ramp) + bottom * ramp).astype(np.uint8)
+    image = Image.fromarray(np.repeat(column[:, None, :], width, axis=1))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(shapes):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        colour = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=colour)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=colour)
+    return image
+
+class RequestMix:
+    """Deterministic person/garment images for request i, cycling through sizes and garments"""
+
+    def __init__(self, sizes, garments=8, repeat_images=0, seed=0, garment_images=None):
+        self.sizes = sizes
+        self.garments = len(garment_images) if garment_images else garments
+        self.repeat_images = repeat_images
+        self.seed = seed
+        self.garment_images = garment_images
+
+    def person(self, i):
+        # Unless images repeat, every request gets distinct pixels, so no result cache hits
+        image_index = i % self.repeat_images if self.repeat_images else i
+        size = self.sizes[image_index % len(self.sizes)]
+        return _synthetic_image(size, self.seed * 1_000_003 + image_index)
+
+    def garment(self, i):
+        # A small set of garments, as a shop's catalogue repeats
+        if self.garment_images:
+            return self.garment_images[i % self.garments]
+        return _synthetic_image((256, 256), self.seed * 1_000_003 + 500_009 + i % self.garments, shapes=3)
+
+    def size_label(self, i):
+        image_index = i % self.repeat_images if self.repeat_images else i
+        width, height = self.sizes[image_index % len(self.sizes)]
+        return f"{width}x{height}"
+
+def load_garment_images(directory):
+    """Garment photos of a directory, to control the category mix (random-weight CLIP detects few categories)"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp")))
+    return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names]
+
+def _rss_bytes(pid="self"):
+    """Current resident set size of a process, from /proc (None where unavailable)"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class RSSSampler:
+    """Background thread recording the peak RSS of a process between start() and stop()"""
+
+    def __init__(self, pid="self", interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = _rss_bytes(self.pid)
+        if rss is not None:
+            self.peak_bytes = max(self.peak_bytes or 0, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.peak_bytes = None
+        self._stop.clear()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        # Without /proc, fall back to the process high-water mark
+        if self.peak_bytes is None and self.pid == "self":
+            self.peak_bytes = _max_rss_bytes()
+        return self.peak_bytes
+
+def _category(result_text):
+    """The garment category from a handler's result text"""
+    first_line = (result_text or "").splitlines()[0] if result_text else ""
+    return first_line.split(":", 1)[1].strip() if first_line.startswith("Detected garment:") else first_line[:40]
+
+class InProcessTarget:
+    """Calls utils.process_person_and_garment directly on the calling thread"""
+
+    name = "inprocess"
+
+    def __init__(self):
+        from utils import process_person_and_garment
+        self._process = process_person_and_garment
+
+    def prepare(self, person, garment):
+        return person, garment
+
+    def request(self, prepared):
+        """Run one request, returning (result_text, seconds to first output)"""
+        person, garment = prepared
+        _, result_text = self._process(person, garment, True, True, True, FIXED_SIZE)
+        return result_text, None
+
+    def close(self):
+        pass
+
+class HTTPTarget:
+    """Calls the Gradio app's /process_person_and_garment endpoint through gradio_client"""
+
+    name = "http"
+
+    def __init__(self, url, download_files=False):
+        from gradio_client import Client, handle_file
+        self.url = url
+        self._handle_file = handle_file
+        self._client = Client(url, verbose=False, download_files=download_files)
+        self._directory = tempfile.mkdtemp(prefix="garment_seg_loadtest_")
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, person, garment):
+        # Uploads are files; encoding them is kept out of the measured latency
+        with self._lock:
+            self._counter += 1
+            index = self._counter
+        paths = []
+        for role, image in (("person", person), ("garment", garment)):
+            path = os.path.join(self._directory, f"{index}_{role}.jpg")
+            image.save(path, quality=90)
+            paths.append(path)
+        return paths
+
+    def request(self, prepared):
+        person_path, garment_path = prepared
+        start = time.perf_counter()
+        job = self._client.submit(
+            self._handle_file(person_path), self._handle_file(garment_path), True, True, True,
+            api_name="/process_person_and_garment",
+        )
+        # The handler streams: the first update is the classification text
+        first_output = None
+        for _ in job:
+            if first_output is None:
+                first_output = time.perf_counter() - start
+        _, result_text = job.result()
+        for path in prepared:
+            os.remove(path)
+        return result_text, first_output
+
+    def close(self):
+        self._client.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+def _percentile_ms(values, q):
+    return float(np.percentile(np.array(values) * 1000, q)) if values else None
+
+def run_level(target, mix, concurrency, requests, first_index=0, rss_pid="self"):
+    """Send requests with at most concurrency in flight and summarise the level"""
+    latencies, first_outputs, errors = [], [], []
+    categories, sizes = Counter(), Counter()
+    lock = threading.Lock()
+
+    def one(i):
+        prepared = target.prepare(mix.person(i), mix.garment(i))
+        start = time.perf_counter()
+        try:
+            result_text, first_output = target.request(prepared)
+            error = result_text if str(result_text).startswith(ERROR_PREFIXES) else None
+        except Exception as e:
+            result_text, first_output, error = None, None, f"{type(e).__name__}: {e}"
+        latency = time.perf_counter() - start
+        with lock:
+            sizes[mix.size_label(i)] += 1
+            if error is not None:
+                errors.append(error)
+                return
+            latencies.append(latency)
+            categories[_category(result_text)] += 1
+            if first_output is not None:
+                first_outputs.append(first_output)
+
+    sampler = RSSSampler(rss_pid) if rss_pid else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(first_index, first_index + requests)))
+    duration = time.perf_counter() - start
+    peak_rss = sampler.stop() if sampler else None
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "completed": len(latencies),
+        "errors": len(errors),
+        "error_rate": len(errors) / requests if requests else 0.0,
+        "duration_s": duration,
+        "throughput_per_s": len(latencies) / duration if duration else 0.0,
+        "mean_ms": float(np.mean(latencies) * 1000) if latencies else None,
+        "p50_ms": _percentile_ms(latencies, 50),
+        "p95_ms": _percentile_ms(latencies, 95),
+        "p99_ms": _percentile_ms(latencies, 99),
+        "max_ms": float(max(latencies) * 1000) if latencies else None,
+        "first_output_p50_ms": _percentile_ms(first_outputs, 50),
+        "first_output_p95_ms": _percentile_ms(first_outputs, 95),
+        "peak_rss_bytes": peak_rss,
+        "sizes": dict(sizes),
+        "categories": dict(categories),
+        "error_samples": sorted(set(errors))[:5],
+    }
+
+def _launch_app(port):
+    """Launch the Gradio app on localhost in this process, returning (demo, url)"""
+    from app import build_app
+    demo = build_app()
+    demo.launch(server_name="127.0.0.1", server_port=port, prevent_thread_lock=True, quiet=True)
+    return demo, demo.local_url
+
+def run_load_test(mode="inprocess", concurrency_levels=DEFAULT_CONCURRENCY, requests_per_worker=5, sizes=DEFAULT_SIZES,
+                  garments=8, repeat_images=0, warmup=2, url=None, port=7861, server_pid=None, stop_p95_ms=None, seed=0, garment_images=None):
+    """Ramp through concurrency_levels and return a JSON-serialisable report"""
+    demo = None
+    if url is None:
+        # Tiny random-weight models: no network, and the persisted embedding cache is left alone
+        config.PERSIST_TEXT_EMBEDDINGS = False
+        install_tiny_models(seed)
+    if mode == "inprocess":
+        target = InProcessTarget()
+    elif url is not None:
+        target = HTTPTarget(url)
+    else:
+        demo, local_url = _launch_app(port)
+        target = HTTPTarget(local_url)
+
+    # The app launched here shares this process, so its RSS is ours; an external app's
+    # RSS is only known when its pid is given
+    rss_pid = server_pid or ("self" if url is None else None)
+    mix = RequestMix(sizes, garments, repeat_images, seed, garment_images)
+
+    levels = []
+    try:
+        # Model loading, text embeddings and first-call allocations stay out of the ramp
+        if warmup:
+            run_level(target, mix, 1, warmup, first_index=10**9, rss_pid=None)
+
+        next_index = 0
+        for concurrency in concurrency_levels:
+            requests = concurrency * requests_per_worker
+            level = run_level(target, mix, concurrency, requests, next_index, rss_pid)
+            next_index += requests
+            levels.append(level)
+            p95 = f"{level['p95_ms']:9.1f}" if level["p95_ms"] is not None else "      n/a"
+            rss = f"{level['peak_rss_bytes'] / 2**20:8.1f} MiB" if level["peak_rss_bytes"] else "     n/a"
+            print(f"concurrency {concurrency:>3}  {level['throughput_per_s']:7.2f} req/s  p95 {p95} ms  "
+                  f"errors {level['error_rate']:6.1%}  peak RSS {rss}", flush=True)
+            if stop_p95_ms and (level["p95_ms"] is None or level["p95_ms"] > stop_p95_ms):
+                break
+    finally:
+        target.close()
+        if demo is not None:
+            demo.close()
+
+    # Highest concurrency that stayed within the latency target without errors
+    within_target = [
+        level["concurrency"] for level in levels
+        if not level["errors"] and (not stop_p95_ms or level["p95_ms"] <= stop_p95_ms)
+    ]
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": mode,
+            "url": url,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "models": "external" if url else "tiny-random",
+            "sizes": [f"{width}x{height}" for width, height in sizes],
+            "garments": mix.garments,
+            "garment_source": "directory" if garment_images else "synthetic",
+            "repeat_images": repeat_images,
+            "requests_per_worker": requests_per_worker,
+            "segmentation_resolution": config.SEGMENTATION_RESOLUTION,
+            "segmentation_strategy": config.SEGMENTATION_STRATEGY,
+            "app_concurrency_limit": config.APP_CONCURRENCY_LIMIT,
+            "app_queue_max_size": config.APP_QUEUE_MAX_SIZE,
+            "stop_p95_ms": stop_p95_ms,
+        },
+        "levels": levels,
+        "max_concurrency_within_target": max(within_target) if within_target else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test with tiny random-weight models (offline)")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess",
+                        help="Call process_person_and_garment directly, or the Gradio app over localhost")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=DEFAULT_CONCURRENCY, help="Concurrency levels of the ramp")
+    parser.add_argument("--requests-per-worker", type=int, default=5, help="Requests per level = concurrency x this")
+    parser.add_argument("--sizes", nargs="+", type=_parse_size, default=DEFAULT_SIZES, help="Person image sizes as WIDTHxHEIGHT, cycled through")
+    parser.add_argument("--garments", type=int, default=8, help="Distinct garment images cycled through")
+    parser.add_argument("--garment-dir", help="Cycle through the garment images of this directory instead of synthetic ones")
+    parser.add_argument("--repeat-images", type=int, default=0, help="Cycle through this many person images (0: every request is new, so nothing is cached)")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests before the ramp")
+    parser.add_argument("--url", help="Load an already running app at this URL instead of launching one (its own models are used)")
+    parser.add_argument("--port", type=int, default=7861, help="Port of the app launched for --mode http")
+    parser.add_argument("--server-pid", type=int, help="Sample the RSS of this process (the app behind --url)")
+    parser.add_argument("--concurrency-limit", type=int, help="GARMENT_SEG_APP_CONCURRENCY_LIMIT of the launched app")
+    parser.add_argument("--stop-p95-ms", type=float, help="Stop the ramp once p95 latency exceeds this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args()
+    if args.url and args.mode != "http":
+        parser.error("--url requires --mode http")
+    if args.concurrency_limit:
+        config.APP_CONCURRENCY_LIMIT = args.concurrency_limit
+
+    report = run_load_test(
+        args.mode, args.concurrency, args.requests_per_worker, args.sizes, args.garments, args.repeat_images,
+        args.warmup, args.url, args.port, args.server_pid, args.stop_p95_ms, args.seed,
+        load_garment_images(args.garment_dir) if args.garment_dir else None,
+    )
+    print(f"Highest concurrency within target: {report['max_concurrency_within_target']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
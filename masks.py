@@ -0,0 +1,152 @@
+import io
+import base64
+
+import numpy as np
+from PIL import Image
+
+from constants import class_names
+from rendering import PALETTE
+
+# Compact encodings of label maps and per-class binary masks:
+#   "rle"      - COCO run-length encoding with the compressed counts string
+#   "bitplane" - np.packbits of the row-major mask, base64 encoded
+# and palette-mode (P) PNGs for whole label maps. Every encoder has a matching decoder.
+MASK_FORMATS = ("rle", "bitplane")
+
+# COCO RLE
+
+def _run_lengths(mask):
+    """Run lengths of a binary mask in column-major order, starting with a run of zeros"""
+    pixels = np.asarray(mask, dtype=bool).ravel(order="F")
+    if pixels.size == 0:
+        return [0]
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [pixels.size]))
+    counts = np.diff(bounds).tolist()
+    if pixels[0]:
+        counts.insert(0, 0)
+    return counts
+
+def _counts_to_string(counts):
+    """Compress RLE counts into COCO's LEB128-like ASCII string"""
+    chars = []
+    for i, x in enumerate(counts):
+        # Counts after the second are stored as differences to the count two places back
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+def _string_to_counts(string):
+    """Decompress COCO's RLE counts string"""
+    counts, p = [], 0
+    while p < len(string):
+        x, k, more = 0, 0, True
+        while more:
+            c = ord(string[p]) - 48
+            x |= (c & 0x1F) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+def encode_rle(mask):
+    """Encode a binary (H, W) mask as a COCO RLE dict with a compressed counts string"""
+    height, width = mask.shape
+    return {"size": [height, width], "counts": _counts_to_string(_run_lengths(mask))}
+
+def decode_rle(rle):
+    """Decode a COCO RLE dict (compressed string or list of counts) into a bool (H, W) mask"""
+    height, width = rle["size"]
+    counts = rle["counts"]
+    if isinstance(counts, bytes):
+        counts = counts.decode("ascii")
+    if isinstance(counts, str):
+        counts = _string_to_counts(counts)
+    values = np.arange(len(counts)) % 2 == 1  # Runs alternate between zeros and ones
+    pixels = np.repeat(values, counts)
+    return pixels.reshape((height, width), order="F")
+
+# Bit-packed masks
+
+def encode_bitplane(mask):
+    """Encode a binary (H, W) mask as row-major np.packbits bits in base64"""
+    height, width = mask.shape
+    bits = np.packbits(np.asarray(mask, dtype=bool).ravel())
+    return {"size": [height, width], "bits": base64.b64encode(bits.tobytes()).decode("ascii")}
+
+def decode_bitplane(encoded):
+    """Decode a bit-packed mask into a bool (H, W) mask"""
+    height, width = encoded["size"]
+    bits = np.frombuffer(base64.b64decode(encoded["bits"]), dtype=np.uint8)
+    return np.unpackbits(bits, count=height * width).reshape(height, width).astype(bool)
+
+_ENCODERS = {"rle": encode_rle, "bitplane": encode_bitplane}
+_DECODERS = {"rle": decode_rle, "bitplane": decode_bitplane}
+
+def _check_format(mask_format):
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"Unknown mask format {mask_format!r}, expected one of {MASK_FORMATS}")
+
+def encode_masks(label_map, selected_classes=None, mask_format="rle"):
+    """Encode one binary mask per selected class (default: every class present) of a label map"""
+    _check_format(mask_format)
+    if selected_classes is None:
+        selected_classes = [class_names[i] for i in np.unique(label_map) if i != 0]
+    return {
+        class_name: _ENCODERS[mask_format](label_map == class_names.index(class_name))
+        for class_name in selected_classes
+        if class_name in class_names
+    }
+
+def decode_masks(encoded, mask_format="rle"):
+    """Decode the output of encode_masks back into {class name: bool mask}"""
+    _check_format(mask_format)
+    return {class_name: _DECODERS[mask_format](mask) for class_name, mask in encoded.items()}
+
+def masks_to_label_map(masks):
+    """Rebuild a uint8 label map from {class name: bool mask}"""
+    label_map = None
+    for class_name, mask in masks.items():
+        if label_map is None:
+            label_map = np.zeros(mask.shape, dtype=np.uint8)
+        label_map[mask] = class_names.index(class_name)
+    return label_map
+
+# Palette PNGs
+
+def palette_image(label_map):
+    """Wrap a uint8 label map in a palette-mode (P) image coloured with the segmentation palette"""
+    height, width = label_map.shape
+    image = Image.frombytes("P", (width, height), np.ascontiguousarray(label_map, dtype=np.uint8).tobytes())
+    image.putpalette(PALETTE.ravel().tolist())
+    return image
+
+def write_palette_png(label_map, fp, compress_level=6):
+    """Save a label map as a palette PNG (one byte per pixel, shown in colour by image viewers)"""
+    palette_image(label_map).save(fp, format="PNG", compress_level=compress_level)
+
+def palette_png_bytes(label_map, compress_level=6):
+    """Return the palette PNG of a label map as bytes"""
+    buffer = io.BytesIO()
+    write_palette_png(label_map, buffer, compress_level)
+    return buffer.getvalue()
+
+def read_palette_png(fp):
+    """Read a label map back from a palette (or greyscale) PNG"""
+    with Image.open(fp) as image:
+        if image.mode not in ("P", "L"):
+            raise ValueError(f"Expected a palette or greyscale PNG, got mode {image.mode}")
+        return np.array(image, dtype=np.uint8)
@@ -0,0 +1,132 @@
+import math
+import threading
+from contextlib import contextmanager
+
+import config
+from metrics import inc
+
+# Memory budget guard. Each request's peak footprint is estimated from its image size
+# before it runs; requests that would push the process over MEMORY_BUDGET_BYTES are
+# downscaled or wait until earlier requests release their share.
+
+MEMORY_POLICIES = ("downscale", "queue")
+
+# SegFormer classes and logit height at its 512x512 input (logits are 1/4 of the input)
+_NUM_CLASSES = 18
+_LOGIT_HEIGHT = 128
+
+class MemoryBudgetError(RuntimeError):
+    """Raised when a request cannot get its memory share within the queue timeout"""
+
+def _label_pixels(image_size, resolution, fixed_size):
+    # The label map, and everything rendered from it, is at the image size only in "full" mode
+    return image_size[0] * image_size[1] if resolution == "full" else fixed_size[0] * fixed_size[1]
+
+def estimate_render_bytes(image_size, resolution=None, fixed_size=(400, 400)):
+    """Estimated peak bytes of rendering the results of an already segmented image"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    label_pixels = _label_pixels(image_size, resolution, fixed_size)
+    # The image and its label map, plus the rendering buffers; no model activations
+    return 3 * image_size[0] * image_size[1] + label_pixels + 14 * label_pixels
+
+def estimate_request_bytes(image_size, resolution=None, fixed_size=(400, 400)):
+    """Estimated peak bytes of segmenting and rendering an image of image_size=(width, height)"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    width, height = image_size
+    pixels = width * height
+
+    # The decoded RGB image stays alive for the whole request, next to the model's activations
+    total = 3 * pixels + config.MEMORY_INFERENCE_BYTES
+
+    label_pixels = _label_pixels(image_size, resolution, fixed_size)
+    total += label_pixels
+
+    # The stages run one after another, so only the largest one adds to the peak:
+    # the preprocessor's uint8 copy of the image; the tiled upsample (logits interpolated
+    # along x for every logit row, one float band of rows and its argmax); and rendering
+    # (filtered label map, colour image, overlay LUT index and result, PIL copies)
+    preprocess = 3 * pixels
+    upsample = 4 * _NUM_CLASSES * width * (_LOGIT_HEIGHT + 2 * config.SEGMENTATION_TILE_ROWS) if resolution == "full" else 0
+    render = 14 * label_pixels
+    return total + max(preprocess, upsample, render)
+
+def _fitting_scale(image_size, target_bytes, resolution, fixed_size):
+    """Largest scale (at most 1) whose estimate fits target_bytes, never below the display size"""
+    min_scale = min(1.0, max(fixed_size[0] / image_size[0], fixed_size[1] / image_size[1]))
+    scale = 1.0
+    while scale > min_scale:
+        size = (max(1, int(image_size[0] * scale)), max(1, int(image_size[1] * scale)))
+        if estimate_request_bytes(size, resolution, fixed_size) <= target_bytes:
+            return scale
+        # The estimate grows roughly with the pixel count
+        scale *= 0.9
+    return min_scale
+
+class MemoryGuard:
+    """Admits requests while their summed estimated peak memory stays within a budget"""
+
+    def __init__(self, budget_bytes=None, policy=None, queue_timeout=None):
+        self.budget_bytes = config.MEMORY_BUDGET_BYTES if budget_bytes is None else budget_bytes
+        self.policy = policy or config.MEMORY_POLICY
+        if self.policy not in MEMORY_POLICIES:
+            raise ValueError(f"Unknown memory policy {self.policy!r}, expected one of {MEMORY_POLICIES}")
+        self.queue_timeout = config.MEMORY_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        self.reserved_bytes = 0
+        self._condition = threading.Condition()
+
+    def _downscale(self, image, target_bytes, resolution, fixed_size):
+        scale = _fitting_scale(image.size, target_bytes, resolution, fixed_size)
+        if scale >= 1.0:
+            return image
+        size = (max(1, math.floor(image.size[0] * scale)), max(1, math.floor(image.size[1] * scale)))
+        inc("garment_seg_memory_admissions_total", {"result": "downscaled"})
+        return image.resize(size)
+
+    @contextmanager
+    def admit(self, image, resolution=None, fixed_size=(400, 400)):
+        """Reserve the image's estimated memory for the duration of the block, yielding the image to use"""
+        if not self.budget_bytes:
+            yield image
+            return
+
+        # An image that could never fit is always downscaled; with the "downscale"
+        # policy, so is one that does not fit in what other requests left free
+        estimate = estimate_request_bytes(image.size, resolution, fixed_size)
+        limit_bytes = self.budget_bytes
+        if self.policy == "downscale":
+            with self._condition:
+                limit_bytes = max(self.budget_bytes - self.reserved_bytes, 0)
+        if estimate > limit_bytes:
+            image = self._downscale(image, limit_bytes, resolution, fixed_size)
+            estimate = estimate_request_bytes(image.size, resolution, fixed_size)
+
+        with self.reserve(estimate):
+            yield image
+
+    @contextmanager
+    def reserve(self, estimate):
+        """Reserve estimate bytes for the duration of the block, waiting up to the queue timeout"""
+        if not self.budget_bytes:
+            yield
+            return
+
+        with self._condition:
+            # A request running alone is always admitted, even above the budget
+            fits = lambda: self.reserved_bytes == 0 or self.reserved_bytes + estimate <= self.budget_bytes
+            if not fits():
+                inc("garment_seg_memory_admissions_total", {"result": "queued"})
+                if not self._condition.wait_for(fits, timeout=self.queue_timeout):
+                    inc("garment_seg_memory_admissions_total", {"result": "rejected"})
+                    raise MemoryBudgetError("Not enough memory to process the image right now, please try again")
+            self.reserved_bytes += estimate
+        inc("garment_seg_memory_admissions_total", {"result": "admitted"})
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved_bytes -= estimate
+                self._condition.notify_all()
+
+# Process-wide guard (each worker process of a pool has its own budget)
+memory_guard = MemoryGuard()
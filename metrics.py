@@ -0,0 +1,226 @@
+import time
+import bisect
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MEGAPIXEL_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 12.0, 16.0, 24.0, 50.0)
+BYTES_BUCKETS = tuple(2 ** power for power in range(20, 33))  # 1 MiB to 4 GiB
+
+# Metric name -> (type, help text, buckets)
+_definitions = {
+    "garment_seg_stage_seconds": ("histogram", "Latency of each pipeline stage", LATENCY_BUCKETS),
+    "garment_seg_input_megapixels": ("histogram", "Size of the input images", MEGAPIXEL_BUCKETS),
+    "garment_seg_requests_total": ("counter", "Requests handled", None),
+    "garment_seg_errors_total": ("counter", "Requests that failed with an exception", None),
+    "garment_seg_classifications_total": ("counter", "Garment classifications by method", None),
+    "garment_seg_cache_lookups_total": ("counter", "Result cache lookups by outcome", None),
+    "garment_seg_stream_frames_total": ("counter", "Streamed frames by outcome (segmented, reused, dropped)", None),
+    "garment_seg_service_coalesced_total": ("counter", "HTTP service requests answered by an identical in-flight request", None),
+    "garment_seg_memory_admissions_total": ("counter", "Requests admitted by the memory budget guard, by outcome", None),
+    "garment_seg_stage_peak_bytes": ("histogram", "Peak traced allocation of each pipeline stage", BYTES_BUCKETS),
+    "garment_seg_roi_passes_total": ("counter", "Coarse-to-fine segmentations by outcome (refined, whole, empty)", None),
+}
+
+# Metric name -> {label tuple: value}; histogram values are [bucket counts..., sum, count]
+_values = {name: {} for name in _definitions}
+_lock = threading.Lock()
+
+_enabled = config.METRICS_ENABLED
+
+# Per-stage peak memory tracking (tracemalloc + process max RSS), for diagnostics
+_track_memory = False
+_stage_peaks = {}  # stage -> {"peak_traced_bytes": ..., "max_rss_growth_bytes": ..., "count": ...}
+_stage_stack = threading.local()
+
+def enable(value=True):
+    """Turn metric collection on or off"""
+    global _enabled
+    _enabled = value
+
+def is_enabled():
+    return _enabled
+
+def enable_memory_tracking(value=True):
+    """Record the peak allocation of every timed stage (slows Python-heavy stages down)"""
+    global _track_memory
+    if value and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _track_memory = value
+
+if config.MEMORY_TRACKING:
+    enable_memory_tracking()
+
+def define(name, kind, help_text, buckets=None):
+    """Register an additional counter or histogram"""
+    with _lock:
+        _definitions[name] = (kind, help_text, buckets)
+        _values.setdefault(name, {})
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def inc(name, labels=None, amount=1):
+    """Increment a counter"""
+    if not _enabled:
+        return
+    key = _label_key(labels)
+    with _lock:
+        series = _values[name]
+        series[key] = series.get(key, 0) + amount
+
+def observe(name, value, labels=None):
+    """Record a value in a histogram"""
+    if not _enabled:
+        return
+    buckets = _definitions[name][2]
+    key = _label_key(labels)
+    with _lock:
+        series = _values[name]
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(buckets) + 2)
+        index = bisect.bisect_left(buckets, value)
+        if index < len(buckets):
+            counts[index] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+def drain():
+    """Return the values recorded so far and reset them (e.g. to ship a worker's metrics to its parent)"""
+    with _lock:
+        drained = {name: series for name, series in _values.items() if series}
+        for name in drained:
+            _values[name] = {}
+    return drained
+
+def merge(values):
+    """Add values returned by drain() in another process to this process's metrics"""
+    with _lock:
+        for name, series in values.items():
+            target = _values.setdefault(name, {})
+            for key, value in series.items():
+                if isinstance(value, list):
+                    counts = target.get(key)
+                    target[key] = value if counts is None else [a + b for a, b in zip(counts, value)]
+                else:
+                    target[key] = target.get(key, 0) + value
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@contextmanager
+def _timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("garment_seg_stage_seconds", time.perf_counter() - start, {"stage": stage})
+
+@contextmanager
+def _tracked(stage):
+    """Time a stage and record its peak traced allocation and growth of the process max RSS"""
+    # tracemalloc has one peak per process: nested stages reset it, so each frame keeps
+    # the highest absolute peak seen by its children. Concurrent requests share it too:
+    # their allocations can inflate a stage's peak, and a concurrent stage's reset_peak()
+    # can discard it before it is read, so under load the numbers may be too high or too low.
+    stack = getattr(_stage_stack, "frames", None)
+    if stack is None:
+        stack = _stage_stack.frames = []
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    frame = {"child_peak": 0}
+    stack.append(frame)
+    rss_before = _max_rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("garment_seg_stage_seconds", time.perf_counter() - start, {"stage": stage})
+        stack.pop()
+        peak = max(tracemalloc.get_traced_memory()[1], frame["child_peak"])
+        if stack:
+            stack[-1]["child_peak"] = max(stack[-1]["child_peak"], peak)
+        peak_bytes = max(0, peak - baseline)
+        rss_growth = _max_rss_bytes() - rss_before
+        observe("garment_seg_stage_peak_bytes", peak_bytes, {"stage": stage})
+        with _lock:
+            record = _stage_peaks.setdefault(stage, {"peak_traced_bytes": 0, "max_rss_growth_bytes": 0, "count": 0})
+            record["peak_traced_bytes"] = max(record["peak_traced_bytes"], peak_bytes)
+            record["max_rss_growth_bytes"] = max(record["max_rss_growth_bytes"], rss_growth)
+            record["count"] += 1
+
+def time_stage(stage):
+    """Context manager recording the latency (and, when tracked, the peak memory) of a pipeline stage"""
+    if _track_memory:
+        return _tracked(stage)
+    if not _enabled:
+        return nullcontext()
+    return _timed(stage)
+
+def stage_peaks():
+    """Largest peak traced allocation and max RSS growth seen for each stage"""
+    with _lock:
+        return {stage: dict(record) for stage, record in _stage_peaks.items()}
+
+def observe_image(image, role):
+    """Record the size of an input image"""
+    if _enabled and image is not None:
+        observe("garment_seg_input_megapixels", image.size[0] * image.size[1] / 1e6, {"input": role})
+
+def _format_labels(key, extra=None):
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+def render_prometheus():
+    """Return all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for name, (kind, help_text, buckets) in _definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(_values[name].items()):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+                    continue
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', bound))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(key)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the app's logs
+
+def start_metrics_server(port=None, host=None):
+    """Serve /metrics on a background thread and enable collection"""
+    enable()
+    server = ThreadingHTTPServer((host or config.METRICS_HOST, port or config.METRICS_PORT), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
@@ -1,21 +1,103 @@
+import os
+import threading
 import torch
 import torch.nn as nn
+from PIL import Image
 from transformers import SegformerImageProcessor, AutoModelForSemanticSegmentation, CLIPProcessor, CLIPModel
 
+import config
+from backends import wrap_segformer, wrap_clip
+
+def _pretrained_kwargs(source):
+    """Extra from_pretrained arguments for a hub id or a local snapshot"""
+    if os.path.isdir(source):
+        # Local snapshot: never go to the hub; safetensors weights are memory-mapped
+        return {"local_files_only": True}
+    return {}
+
 # Load the SegFormer model and processor for segmentation
-def load_segformer_model():
+def load_segformer_model(source=None, backend=None):
     """Load and return the SegFormer model and processor"""
-    processor = SegformerImageProcessor.from_pretrained("mattmdjaga/segformer_b2_clothes")
-    model = AutoModelForSemanticSegmentation.from_pretrained("mattmdjaga/segformer_b2_clothes")
-    return processor, model
+    source = source or config.SEGFORMER_MODEL
+    kwargs = _pretrained_kwargs(source)
+    processor = SegformerImageProcessor.from_pretrained(source, **kwargs)
+    model = AutoModelForSemanticSegmentation.from_pretrained(source, **kwargs)
+    model.eval()
+    return processor, wrap_segformer(model, backend, source)
 
 # Load Fashion-CLIP model for garment classification
-def load_clip_model():
+def load_clip_model(source=None, backend=None):
     """Load and return the Fashion-CLIP model and processor"""
-    model = CLIPModel.from_pretrained("patrickjohncyh/fashion-clip")
-    processor = CLIPProcessor.from_pretrained("patrickjohncyh/fashion-clip")
-    return model, processor
+    source = source or config.CLIP_MODEL
+    kwargs = _pretrained_kwargs(source)
+    model = CLIPModel.from_pretrained(source, **kwargs)
+    processor = CLIPProcessor.from_pretrained(source, **kwargs)
+    model.eval()
+    return wrap_clip(model, backend, source), processor
+
+# Registry of lazily loaded models: nothing is built until first use
+_loaders = {
+    "segformer": load_segformer_model,
+    "clip": load_clip_model,
+}
+_models = {}
+_locks = {name: threading.Lock() for name in _loaders}
+
+def get_model(name):
+    """Return the components registered under name, loading them on first use"""
+    components = _models.get(name)
+    if components is None:
+        with _locks[name]:
+            components = _models.get(name)
+            if components is None:
+                components = _loaders[name]()
+                _models[name] = components
+    return components
+
+def get_segformer():
+    """Return the (processor, model) pair for SegFormer"""
+    return get_model("segformer")
+
+def get_clip():
+    """Return the (model, processor) pair for Fashion-CLIP"""
+    return get_model("clip")
+
+def set_model(name, components):
+    """Install already-built components under name (e.g. tiny test models)"""
+    with _locks[name]:
+        _models[name] = components
+
+def unload_model(name):
+    """Drop a loaded model so its memory can be reclaimed"""
+    with _locks[name]:
+        _models.pop(name, None)
+
+def is_loaded(name):
+    """Whether the model registered under name has been built"""
+    return name in _models
+
+def warmup(names=None):
+    """Load the given models (default: all) and run a dummy forward pass through each"""
+    dummy = Image.new("RGB", (64, 64))
+    for name in names or list(_loaders):
+        with torch.no_grad():
+            if name == "segformer":
+                processor, model = get_segformer()
+                model(**processor(images=dummy, return_tensors="pt"))
+            elif name == "clip":
+                model, processor = get_clip()
+                model.get_image_features(**processor(images=dummy, return_tensors="pt"))
+
+# Backwards compatibility: `from models import segformer_model` still works, lazily
+_legacy_names = {
+    "segformer_processor": ("segformer", 0),
+    "segformer_model": ("segformer", 1),
+    "clip_model": ("clip", 0),
+    "clip_processor": ("clip", 1),
+}
 
-# Initialize models
-segformer_processor, segformer_model = load_segformer_model()
-clip_model, clip_processor = load_clip_model()
+def __getattr__(name):
+    if name in _legacy_names:
+        model_name, index = _legacy_names[name]
+        return get_model(model_name)[index]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,89 @@
+import weakref
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# Tensor-native preprocessing for SegFormer and Fashion-CLIP. Each image is converted to a
+# uint8 tensor once (and kept while the image is alive, so the CLIP pass and a SegFormer
+# fallback on the same garment share it); resizing uses torch's antialiased uint8
+# interpolation and rescale + normalise is one fused multiply-add over the whole batch.
+# The resized pixels are identical to the Hugging Face processors'; the fused normalise only
+# differs from theirs by float32 rounding, at most about 7e-7 in the normalised values.
+
+# PIL resample filters used by the processors -> torch interpolation modes
+_INTERPOLATION = {
+    Image.BILINEAR: "bilinear",
+    Image.BICUBIC: "bicubic",
+}
+
+# id(image) -> (weak reference to the image, uint8 (3, H, W) tensor)
+_image_tensors = {}
+
+def image_tensor(image):
+    """Return the image as a uint8 (3, H, W) tensor, converting it only once per image"""
+    key = id(image)
+    entry = _image_tensors.get(key)
+    if entry is not None and entry[0]() is image:
+        return entry[1]
+
+    rgb = image if image.mode == "RGB" else image.convert("RGB")
+    tensor = torch.from_numpy(np.array(rgb)).permute(2, 0, 1)
+    _image_tensors[key] = (weakref.ref(image), tensor)
+    # Forget the tensor as soon as the image is garbage collected
+    weakref.finalize(image, _image_tensors.pop, key, None)
+    return tensor
+
+def _resize(tensor, size, resample):
+    """Antialiased resize of a uint8 (3, H, W) tensor to size=(height, width), returned as float"""
+    if tuple(tensor.shape[1:]) == tuple(size):
+        return tensor.float()
+    # The tensor is a channels-last view of the decoded pixels, which takes torch's
+    # vectorised uint8 path (an order of magnitude faster than resizing in float)
+    resized = F.interpolate(
+        tensor.unsqueeze(0), size=size,
+        mode=_INTERPOLATION.get(resample, "bilinear"), align_corners=False, antialias=True,
+    )[0]
+    return resized.float()
+
+def _normalize(batch, processor):
+    """Fused rescale and normalise of a float (N, 3, H, W) batch of 0-255 values"""
+    mean = torch.tensor(processor.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+    std = torch.tensor(processor.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+    scale = processor.rescale_factor / std
+    return batch.mul_(scale).sub_(mean / std)
+
+def _image_processor(processor):
+    # CLIPProcessor wraps the image processor together with the tokenizer
+    return getattr(processor, "image_processor", processor)
+
+def segformer_pixel_values(images, processor, size=None):
+    """SegFormer pixel_values for a batch of images: resize to size=(height, width) (default: the processor's) and normalise"""
+    processor = _image_processor(processor)
+    size = size or (processor.size["height"], processor.size["width"])
+    batch = torch.stack([_resize(image_tensor(image), size, processor.resample) for image in images])
+    return _normalize(batch, processor)
+
+def _shortest_edge_size(height, width, shortest_edge):
+    """Output size when the shorter side is resized to shortest_edge, as the HF processors compute it"""
+    short, long = (height, width) if height <= width else (width, height)
+    new_short, new_long = shortest_edge, int(shortest_edge * long / short)
+    return (new_short, new_long) if height <= width else (new_long, new_short)
+
+def _center_crop(tensor, crop_height, crop_width):
+    height, width = tensor.shape[1:]
+    top, left = (height - crop_height) // 2, (width - crop_width) // 2
+    return tensor[:, top:top + crop_height, left:left + crop_width]
+
+def clip_pixel_values(images, processor):
+    """CLIP pixel_values for a batch of images: resize the shortest edge, centre crop and normalise"""
+    processor = _image_processor(processor)
+    crop = (processor.crop_size["height"], processor.crop_size["width"])
+    shortest_edge = processor.size["shortest_edge"]
+    crops = []
+    for image in images:
+        tensor = image_tensor(image)
+        size = _shortest_edge_size(tensor.shape[1], tensor.shape[2], shortest_edge)
+        crops.append(_center_crop(_resize(tensor, size, processor.resample), *crop))
+    return _normalize(torch.stack(crops), processor)
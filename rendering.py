@@ -0,0 +1,70 @@
+from functools import lru_cache
+
+import numpy as np
+
+from constants import class_names, color_map
+
+# Transparency factor of the segmentation overlay
+OVERLAY_ALPHA = 0.5
+
+# Palette in 0-255 floats, exactly as the colour map defines it
+_PALETTE_FLOAT = np.array([color_map(i)[:3] for i in range(len(class_names))]) * 255
+
+# uint8 palette LUT: class index -> RGB
+PALETTE = _PALETTE_FLOAT.astype(np.uint8)
+
+# Channel offsets into the flattened (class, pixel value, channel) blend LUT
+_CHANNEL_OFFSETS = np.arange(3, dtype=np.uint16)
+
+@lru_cache(maxsize=None)
+def _selection_lut(selected):
+    """uint8 LUT mapping every unselected class to background"""
+    keep = np.zeros(256, dtype=bool)
+    for class_name in selected:
+        if class_name in class_names:
+            keep[class_names.index(class_name)] = True
+    return np.where(keep, np.arange(256), 0).astype(np.uint8)
+
+@lru_cache(maxsize=None)
+def _blend_lut(alpha):
+    """Flattened LUT of overlay values indexed by (class, pixel value, channel)"""
+    values = np.arange(256, dtype=np.float64)
+    lut = values[None, :, None] * (1 - alpha) + _PALETTE_FLOAT[:, None, :] * alpha
+    lut[0] = values[:, None]  # Background pixels keep the original colour
+    # Truncate like the float blend assigned into a uint8 image did
+    return lut.astype(np.uint8).ravel()
+
+def filter_label_map(label_map, selected_classes=None):
+    """Keep only the selected classes, setting all others to background (0)"""
+    if not selected_classes:
+        return label_map
+    return _selection_lut(frozenset(selected_classes))[label_map]
+
+def colorize(label_map):
+    """Map a label map to an RGB uint8 image using the palette"""
+    return PALETTE[label_map]
+
+def blend_overlay(image_array, label_map, alpha=OVERLAY_ALPHA):
+    """Alpha-blend the class colours over an RGB uint8 image, leaving background untouched"""
+    # Built in place: full-size temporaries dominate the peak memory of large images
+    index = image_array.astype(np.uint16)
+    index *= 3
+    class_offsets = label_map.astype(np.uint16)
+    class_offsets *= 256 * 3
+    index += class_offsets[..., None]
+    del class_offsets
+    index += _CHANNEL_OFFSETS
+    # Fancy indexing casts the uint16 index in buffered chunks; np.take would first
+    # convert the whole index to an intp array, four times its size
+    return _blend_lut(alpha)[index]
+
+def to_rgb_array(image):
+    """Return the image as an (H, W, 3) uint8 array"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+def render_segmentation(image, label_map, selected_classes=None, alpha=OVERLAY_ALPHA):
+    """Return the filtered label map, its colourised image and the overlay as arrays"""
+    label_map = filter_label_map(label_map, selected_classes)
+    return label_map, colorize(label_map), blend_overlay(to_rgb_array(image), label_map, alpha)
@@ -1,133 +1,282 @@
+import math
+
 import torch
 import torch.nn as nn
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
-import io
 from collections import Counter
 import gradio as gr
 
-from models import segformer_model, segformer_processor
-from constants import class_names, color_map
+import config
+from models import get_segformer
+from batching import get_batcher
+from metrics import time_stage, inc
+from constants import class_names
+from rendering import filter_label_map, colorize, blend_overlay, to_rgb_array
+from legend import render_legend
+from masks import encode_masks
+from preprocessing import segformer_pixel_values
 
-def segment_image(image, selected_classes=None, show_original=True, show_segmentation=True, show_overlay=True, fixed_size=(400, 400)):
-    """Segment the image based on selected classes with consistent output sizes"""
-    # Process the image
-    inputs = segformer_processor(images=image, return_tensors="pt")
-    
-    # Get model predictions
-    outputs = segformer_model(**inputs)
-    logits = outputs.logits.cpu()
-    
-    # Upsample the logits to match the original image size
-    upsampled_logits = nn.functional.interpolate(
-        logits,
-        size=image.size[::-1],  # (height, width)
-        mode="bilinear",
-        align_corners=False,
-    )
-    
-    # Get the predicted segmentation map
-    pred_seg = upsampled_logits.argmax(dim=1)[0].numpy()
-    
-    # Filter classes if specified
-    if selected_classes and len(selected_classes) > 0:
-        # Create a mask for selected classes
-        mask = np.zeros_like(pred_seg, dtype=bool)
-        for class_name in selected_classes:
-            if class_name in class_names:
-                class_idx = class_names.index(class_name)
-                mask = np.logical_or(mask, pred_seg == class_idx)
+# Resolutions a label map can be computed at:
+#   "full"    - exact labels at the original image size, upsampled a band of rows at a time
+#   "display" - labels computed directly at the requested output size
+#   "logits"  - argmax at the model's logit resolution, nearest-resized to the output size
+RESOLUTION_MODES = ("full", "display", "logits")
+
+# How a label map for a class selection is computed:
+#   "single" - one SegFormer pass over the whole image
+#   "roi"    - a coarse pass locates the selected classes, a second pass refines their region
+SEGMENTATION_STRATEGIES = ("single", "roi")
+
+# Images returned by segment_image, in gallery order (the legend is always included)
+SEGMENT_OUTPUTS = ("original", "segmentation", "overlay", "legend")
+
+def _bilinear_weights(in_size, out_size):
+    """Interpolation matrix matching interpolate(mode="bilinear", align_corners=False) along one axis"""
+    scale = in_size / out_size
+    src = ((torch.arange(out_size, dtype=torch.float32) + 0.5) * scale - 0.5).clamp(min=0)
+    lower = src.floor().long().clamp(max=in_size - 1)
+    upper = (lower + 1).clamp(max=in_size - 1)
+    upper_weight = src - lower
+    
+    weights = torch.zeros(out_size, in_size)
+    rows = torch.arange(out_size)
+    weights.index_put_((rows, lower), 1 - upper_weight, accumulate=True)
+    weights.index_put_((rows, upper), upper_weight, accumulate=True)
+    return weights
+
+def upsample_argmax(logits, size, tile_rows=None):
+    """Argmax of the bilinearly upsampled (C, h, w) logits at size=(height, width), computed in row tiles"""
+    height, width = size
+    tile_rows = tile_rows or config.SEGMENTATION_TILE_ROWS
+    _, logit_height, logit_width = logits.shape
+    
+    # Interpolate along x once for every logit row, then along y one band at a time,
+    # so the full-resolution float tensor never exists at once
+    row_weights = _bilinear_weights(logit_height, height)
+    columns = torch.matmul(logits.float(), _bilinear_weights(logit_width, width).t())
+    
+    labels = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, tile_rows):
+        band = torch.einsum("hi,ciw->chw", row_weights[top:top + tile_rows], columns)
+        labels[top:top + tile_rows] = band.argmax(dim=0).numpy()
+    return labels
+
+def logits_to_label_map(logits, image_size, mode=None, output_size=None):
+    """Turn (C, h, w) logits into a uint8 label map for an image of image_size=(width, height)"""
+    mode = mode or config.SEGMENTATION_RESOLUTION
+    if mode not in RESOLUTION_MODES:
+        raise ValueError(f"Unknown segmentation resolution {mode!r}, expected one of {RESOLUTION_MODES}")
+    
+    if mode == "logits":
+        labels = logits.argmax(dim=0).to(torch.uint8).numpy()
+        if output_size is not None:
+            labels = np.array(Image.fromarray(labels).resize(output_size, Image.NEAREST))
+        return labels
+    
+    target_size = output_size if mode == "display" and output_size is not None else image_size
+    with time_stage("upsample_argmax"):
+        return upsample_argmax(logits, target_size[::-1])  # (height, width)
+
+def predict_logits(images, size=None):
+    """Run SegFormer once over a batch of images and return the low-resolution logits"""
+    segformer_processor, segformer_model = get_segformer()
+    
+    # Process the images (the processor resizes them all to the same size, or to size=(height, width))
+    with time_stage("segformer_preprocess"):
+        if config.PREPROCESSING == "tensor":
+            inputs = {"pixel_values": segformer_pixel_values(images, segformer_processor, size)}
+        else:
+            size_override = {"size": {"height": size[0], "width": size[1]}} if size else {}
+            inputs = segformer_processor(images=list(images), return_tensors="pt", **size_override)
+    
+    # Get model predictions for the whole batch in one forward pass
+    with time_stage("segformer_forward"), torch.no_grad():
+        outputs = segformer_model(**inputs)
+    return outputs.logits.cpu()
+
+def predict_label_maps(images, mode=None, output_sizes=None):
+    """Run SegFormer once over a batch of images and return one label map per image"""
+    logits = predict_logits(images)
+    output_sizes = output_sizes or [None] * len(images)
+    return [
+        logits_to_label_map(image_logits, image.size, mode, output_size)
+        for image, image_logits, output_size in zip(images, logits, output_sizes)
+    ]
+
+def _predict_label_map_requests(requests):
+    """Batch function for the micro-batcher: requests are (image, mode, output_size) tuples"""
+    logits = predict_logits([image for image, _, _ in requests])
+    return [
+        logits_to_label_map(image_logits, image.size, mode, output_size)
+        for (image, mode, output_size), image_logits in zip(requests, logits)
+    ]
+
+def predict_label_map(image, mode=None, output_size=None):
+    """Return the SegFormer label map for a single image"""
+    if config.MICRO_BATCHING:
+        # Share the forward pass with concurrent requests
+        return get_batcher("segformer", _predict_label_map_requests)((image, mode, output_size))
+    return predict_label_maps([image], mode, [output_size])[0]
+
+def class_region(label_map, selected_classes, image_size, margin=None, aspect=1.0):
+    """Box (left, top, right, bottom) in image pixels around the selected classes of a label map, or None"""
+    margin = config.ROI_MARGIN if margin is None else margin
+    mask = filter_label_map(label_map, selected_classes) != 0
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    
+    # Label map cells -> image pixels
+    image_width, image_height = image_size
+    scale_x, scale_y = image_width / label_map.shape[1], image_height / label_map.shape[0]
+    left, right = cols[0] * scale_x, (cols[-1] + 1) * scale_x
+    top, bottom = rows[0] * scale_y, (rows[-1] + 1) * scale_y
+    
+    # Grow by the margin, then towards the model's input aspect ratio so the crop is not
+    # distorted when the processor resizes it
+    width, height = (right - left) * (1 + 2 * margin), (bottom - top) * (1 + 2 * margin)
+    width, height = max(width, height * aspect), max(height, width / aspect)
+    width, height = min(width, image_width), min(height, image_height)
+    left = min(max((left + right - width) / 2, 0), image_width - width)
+    top = min(max((top + bottom - height) / 2, 0), image_height - height)
+    return (math.floor(left), math.floor(top), min(math.ceil(left + width), image_width), min(math.ceil(top + height), image_height))
+
+def predict_label_map_roi(image, selected_classes, mode=None, output_size=None):
+    """Coarse-to-fine label map: locate the selected classes at low resolution, then segment only their region"""
+    segformer_processor, _ = get_segformer()
+    processor_size = getattr(segformer_processor, "image_processor", segformer_processor).size
+    mode = mode or config.SEGMENTATION_RESOLUTION
+    if mode == "logits" and output_size is None:
+        # The grid of the plain strategy's logits map (SegFormer's logits are 1/4 of its input),
+        # not the coarser one of the coarse pass
+        output_size = (math.ceil(processor_size["width"] / 4), math.ceil(processor_size["height"] / 4))
+    
+    with time_stage("roi_coarse"):
+        coarse_logits = predict_logits([image], (config.ROI_COARSE_SIZE, config.ROI_COARSE_SIZE))[0]
+        box = class_region(
+            coarse_logits.argmax(dim=0).to(torch.uint8).numpy(), selected_classes, image.size,
+            aspect=processor_size["width"] / processor_size["height"],
+        )
+    
+    if box is None:
+        # None of the selected classes are present, so the coarse labels filter to the same empty mask
+        inc("garment_seg_roi_passes_total", {"result": "empty"})
+        return logits_to_label_map(coarse_logits, image.size, mode, output_size)
+    
+    left, top, right, bottom = box
+    if (right - left) * (bottom - top) > config.ROI_MAX_AREA * image.size[0] * image.size[1]:
+        # The garment fills most of the picture: a crop would not add any detail
+        inc("garment_seg_roi_passes_total", {"result": "whole"})
+        return predict_label_map(image, mode, output_size)
+    
+    # Coarse labels everywhere, then the region's refined labels pasted over them
+    label_map = logits_to_label_map(coarse_logits, image.size, mode, output_size)
+    scale_x, scale_y = label_map.shape[1] / image.size[0], label_map.shape[0] / image.size[1]
+    cell_left, cell_right = round(left * scale_x), round(right * scale_x)
+    cell_top, cell_bottom = round(top * scale_y), round(bottom * scale_y)
+    if cell_right > cell_left and cell_bottom > cell_top:
+        label_map[cell_top:cell_bottom, cell_left:cell_right] = predict_label_map(
+            image.crop(box), "display", (cell_right - cell_left, cell_bottom - cell_top),
+        )
+    inc("garment_seg_roi_passes_total", {"result": "refined"})
+    return label_map
+
+def predict_class_label_map(image, selected_classes=None, mode=None, output_size=None):
+    """Label map used to segment selected_classes, computed with config.SEGMENTATION_STRATEGY"""
+    strategy = config.SEGMENTATION_STRATEGY
+    if strategy not in SEGMENTATION_STRATEGIES:
+        raise ValueError(f"Unknown segmentation strategy {strategy!r}, expected one of {SEGMENTATION_STRATEGIES}")
+    # Without a class selection there is no region to refine
+    if strategy == "roi" and selected_classes:
+        return predict_label_map_roi(image, selected_classes, mode, output_size)
+    return predict_label_map(image, mode, output_size)
+
+def segment_label_map(image, selected_classes=None, resolution=None, output_size=None):
+    """Return the raw uint8 label map restricted to the selected classes, skipping rendering"""
+    return filter_label_map(predict_class_label_map(image, selected_classes, resolution, output_size), selected_classes)
+
+def segment_masks(image, selected_classes=None, mask_format="rle", resolution=None, output_size=None, label_map=None):
+    """Return the filtered label map and one compact mask per selected class instead of rendered images"""
+    if label_map is None:
+        label_map = predict_class_label_map(image, selected_classes, resolution, output_size)
+    with time_stage("mask_filtering"):
+        label_map = filter_label_map(label_map, selected_classes)
+    with time_stage("mask_encoding"):
+        encoded = encode_masks(label_map, selected_classes, mask_format)
+    return {"label_map": label_map, "format": mask_format, "masks": encoded}
+
+def label_map_size(fixed_size, resolution=None):
+    """Size the label map is computed at for display at fixed_size (None: the image size)"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    # Everything is shown at fixed_size, so only the exact mode works at full resolution
+    return None if resolution == "full" else fixed_size
+
+def iter_segment_images(image, selected_classes=None, show_original=True, show_segmentation=True, show_overlay=True, fixed_size=(400, 400), resolution=None, label_map=None, overlay_first=False):
+    """Render segment_image's outputs one at a time, yielding (kind, image) pairs with kind in SEGMENT_OUTPUTS"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    output_size = label_map_size(fixed_size, resolution)
+    
+    # Get the predicted segmentation map, unless the caller already has it
+    pred_seg = label_map
+    if pred_seg is None:
+        pred_seg = predict_class_label_map(image, selected_classes, resolution, output_size)
+    if output_size is not None:
+        image = image.resize(output_size)
+    
+    # Filter classes if specified, keeping only selected classes and setting others to background (0)
+    with time_stage("mask_filtering"):
+        pred_seg = filter_label_map(pred_seg, selected_classes)
+    
+    # Prepare output images based on user selection; the overlay is the most useful one,
+    # so progressive callers can have it rendered first
+    kinds = [kind for kind, shown in zip(SEGMENT_OUTPUTS, (show_original, show_segmentation, show_overlay)) if shown]
+    if overlay_first and show_overlay:
+        kinds.remove("overlay")
+        kinds.insert(0, "overlay")
+    
+    for kind in kinds:
+        if kind == "original":
+            # Resize original image to ensure consistent size
+            with time_stage("resize"):
+                output = image.resize(fixed_size)
         
-        # Apply the mask to keep only selected classes, set others to background (0)
-        filtered_seg = np.zeros_like(pred_seg)
-        filtered_seg[mask] = pred_seg[mask]
-        pred_seg = filtered_seg
-    
-    # Create a colored segmentation map
-    colored_seg = np.zeros((pred_seg.shape[0], pred_seg.shape[1], 3))
-    for class_idx in range(len(class_names)):
-        mask = pred_seg == class_idx
-        if mask.any():
-            colored_seg[mask] = color_map(class_idx)[:3]
-    
-    # Create an overlay of the segmentation on the original image
-    image_array = np.array(image)
-    overlay = image_array.copy()
-    alpha = 0.5  # Transparency factor
-    mask = pred_seg > 0  # Exclude background
-    overlay[mask] = overlay[mask] * (1 - alpha) + colored_seg[mask] * 255 * alpha
-    
-    # Prepare output images based on user selection
-    outputs = []
-    
-    if show_original:
-        # Resize original image to ensure consistent size
-        resized_original = image.resize(fixed_size)
-        outputs.append(resized_original)
-    
-    if show_segmentation:
-        seg_image = Image.fromarray((colored_seg * 255).astype('uint8'))
-        # Ensure segmentation has consistent size
-        seg_image = seg_image.resize(fixed_size)
-        outputs.append(seg_image)
-    
-    if show_overlay:
-        overlay_image = Image.fromarray(overlay.astype('uint8'))
-        # Ensure overlay has consistent size
-        overlay_image = overlay_image.resize(fixed_size)
-        outputs.append(overlay_image)
-    
-    # Create a legend for the segmentation classes
-    fig, ax = plt.subplots(figsize=(10, 2))
-    fig.patch.set_alpha(0.0)
-    ax.axis('off')
-    
-    # Create legend patches
-    legend_elements = []
-    for i, class_name in enumerate(class_names):
-        if i == 0 and selected_classes:  # Skip background in legend if filtering
-            continue
-        if not selected_classes or class_name in selected_classes:
-            color = color_map(i)[:3]
-            legend_elements.append(plt.Rectangle((0, 0), 1, 1, color=color))
-    
-    # Only add legend if there are elements to show
-    if legend_elements:
-        legend_class_names = [name for name in class_names if name != "Background" and (not selected_classes or name in selected_classes)]
-        ax.legend(legend_elements, legend_class_names, loc='center', ncol=6)
-    
-    # Save the legend to a bytes buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', transparent=True)
-    buf.seek(0)
-    legend_img = Image.open(buf)
-    
-    plt.close(fig)
-    
-    outputs.append(legend_img)
-    
-    return outputs
-
-def identify_garment_segformer(image):
-    """Identify the dominant garment type using SegFormer"""
-    # Process the image
-    inputs = segformer_processor(images=image, return_tensors="pt")
+        elif kind == "segmentation":
+            # Create a colored segmentation map
+            with time_stage("colorize"):
+                output = Image.fromarray(colorize(pred_seg))
+            # Ensure segmentation has consistent size
+            with time_stage("resize"):
+                output = output.resize(fixed_size)
+        
+        else:
+            # Create an overlay of the segmentation on the original image
+            with time_stage("overlay"):
+                output = Image.fromarray(blend_overlay(to_rgb_array(image), pred_seg))
+            # Ensure overlay has consistent size
+            with time_stage("resize"):
+                output = output.resize(fixed_size)
+        
+        yield kind, output
     
-    # Get model predictions
-    outputs = segformer_model(**inputs)
-    logits = outputs.logits.cpu()
+    # The legend only depends on the selected classes, so it is rendered once per selection
+    with time_stage("legend"):
+        legend_img = render_legend(selected_classes)
     
-    # Upsample the logits to match the original image size
-    upsampled_logits = nn.functional.interpolate(
-        logits,
-        size=image.size[::-1],  # (height, width)
-        mode="bilinear",
-        align_corners=False,
-    )
+    yield "legend", legend_img
+
+def segment_image(image, selected_classes=None, show_original=True, show_segmentation=True, show_overlay=True, fixed_size=(400, 400), resolution=None, label_map=None):
+    """Segment the image based on selected classes with consistent output sizes"""
+    outputs = dict(iter_segment_images(image, selected_classes, show_original, show_segmentation, show_overlay, fixed_size, resolution, label_map))
+    return [outputs[kind] for kind in SEGMENT_OUTPUTS if kind in outputs]
+
+def identify_garment_segformer(image, resolution=None):
+    """Identify the dominant garment type using SegFormer"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
     
-    # Get the predicted segmentation map
-    pred_seg = upsampled_logits.argmax(dim=1)[0].numpy()
+    # Get the predicted segmentation map; pixel proportions are all that matter here,
+    # so anything but the exact mode counts at the logit resolution
+    pred_seg = predict_label_map(image, "full" if resolution == "full" else "logits")
     
     # Count the pixels for each class (excluding background)
     class_counts = Counter(pred_seg.flatten())
@@ -144,7 +293,7 @@ def identify_garment_segformer(image):
         return "No garment detected", None
     
     # Get the most common clothing item
-    dominant_class = max(clothing_counts.items(), key=lambda x: x[1])[0]
+    dominant_class = int(max(clothing_counts.items(), key=lambda x: x[1])[0])
     dominant_class_name = class_names[dominant_class]
     
     return dominant_class_name, dominant_class
@@ -0,0 +1,205 @@
+import io
+import json
+import asyncio
+import hashlib
+from concurrent.futures import Future
+
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Query
+from fastapi.responses import Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from PIL import Image
+
+import config
+from segmentation import RESOLUTION_MODES, segment_masks
+from masks import MASK_FORMATS, palette_png_bytes
+from rendering import filter_label_map
+from cache import get_segments_for_garment_cached, predict_label_map_cached
+from metrics import time_stage, inc
+from memory import memory_guard, MemoryBudgetError
+
+# Headless HTTP service for machine-to-machine traffic. Images are posted as raw bytes
+# (or multipart parts for the combined endpoint) and results come back as compact masks
+# or a palette PNG label map plus JSON metadata; nothing is rendered. It runs the same
+# cached inference core as the UI.
+
+app = FastAPI(title="Garment-based Segmentation")
+
+# Futures of the requests currently running, keyed by endpoint, parameters and body hash
+_inflight = {}
+# Tasks computing those futures, referenced until they finish
+_tasks = set()
+
+async def _compute(key, future, fn, args):
+    """Run fn(*args) in the thread pool and publish its outcome on future"""
+    try:
+        future.set_result(await run_in_threadpool(fn, *args))
+    except asyncio.CancelledError as e:
+        future.set_exception(e)
+        raise
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        del _inflight[key]
+
+async def coalesce(key, fn, *args):
+    """Run fn(*args) in the thread pool, sharing the result with identical concurrent requests"""
+    future = _inflight.get(key)
+    if future is not None:
+        inc("garment_seg_service_coalesced_total")
+    else:
+        # A thread-safe future, so waiters on any event loop can share it. The work runs in
+        # a task no request owns, so the first client disconnecting does not fail the others
+        future = _inflight[key] = Future()
+        task = asyncio.ensure_future(_compute(key, future, fn, args))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    # Shielded so a disconnecting waiter cannot cancel the shared work
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+def _request_key(endpoint, data, *params):
+    digest = hashlib.blake2b(data, digest_size=20)
+    for param in params:
+        digest.update(f"|{param}".encode("utf-8"))
+    return f"{endpoint}:{digest.hexdigest()}"
+
+def _too_large():
+    """413 for a body over SERVICE_MAX_BYTES"""
+    return HTTPException(413, f"Image exceeds the {config.SERVICE_MAX_BYTES} byte limit")
+
+async def read_body(request):
+    """Read a raw request body, rejecting it with a 413 as soon as it passes SERVICE_MAX_BYTES"""
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > config.SERVICE_MAX_BYTES:
+        raise _too_large()
+    # Chunked bodies announce no length, so the cap is also enforced while streaming
+    chunks, total = [], 0
+    async for chunk in request.stream():
+        total += len(chunk)
+        if total > config.SERVICE_MAX_BYTES:
+            raise _too_large()
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+async def read_upload(upload):
+    """Read a multipart file (spooled to disk by the form parser) of at most SERVICE_MAX_BYTES"""
+    if upload.size is not None and upload.size > config.SERVICE_MAX_BYTES:
+        raise _too_large()
+    data = await upload.read(config.SERVICE_MAX_BYTES + 1)
+    if len(data) > config.SERVICE_MAX_BYTES:
+        raise _too_large()
+    return data
+
+def decode_upload(data):
+    """Decode posted image bytes, rejecting empty, oversized or undecodable bodies with a 4xx"""
+    if not data:
+        raise HTTPException(400, "The request body must be an image")
+    if len(data) > config.SERVICE_MAX_BYTES:
+        raise HTTPException(413, f"Image is {len(data)} bytes, the limit is {config.SERVICE_MAX_BYTES}")
+    try:
+        return Image.open(io.BytesIO(data)).convert("RGB")
+    except Exception as e:
+        raise HTTPException(400, f"Cannot decode image: {e}")
+
+def _check_options(resolution, mask_format, size=None):
+    """Validate the query options, returning the resolution and label map size to use"""
+    resolution = resolution or config.SEGMENTATION_RESOLUTION
+    if resolution not in RESOLUTION_MODES:
+        raise HTTPException(422, f"resolution must be one of {RESOLUTION_MODES}")
+    if mask_format not in MASK_FORMATS + ("png",):
+        raise HTTPException(422, f"output must be one of {MASK_FORMATS + ('png',)}")
+    output_size = None
+    if size is not None:
+        try:
+            output_size = tuple(int(side) for side in size.lower().split("x"))
+        except ValueError:
+            output_size = ()
+        if len(output_size) != 2 or min(output_size) < 1:
+            raise HTTPException(422, "size must be WIDTHxHEIGHT")
+    # Display label maps are computed at the size the client shows them at; full ones at the image size
+    if resolution == "display" and output_size is None:
+        raise HTTPException(422, "resolution=display needs size=WIDTHxHEIGHT")
+    return resolution, (None if resolution == "full" else output_size)
+
+def _classify(data):
+    selected_class, segformer_idx, message = get_segments_for_garment_cached(decode_upload(data))
+    return {"selected_classes": selected_class, "segformer_idx": segformer_idx, "message": message}
+
+def _segment(data, selected_classes, resolution, output, output_size=None):
+    """Label map of a person restricted to selected_classes, as masks or a palette PNG"""
+    image = decode_upload(data)
+    if output_size is not None and (output_size[0] > image.width or output_size[1] > image.height):
+        raise HTTPException(422, f"size {output_size[0]}x{output_size[1]} exceeds the image size, use resolution=full")
+    metadata = {"image_size": list(image.size), "resolution": resolution}
+    with memory_guard.admit(image, resolution, fixed_size=output_size or (400, 400)) as image:
+        label_map = predict_label_map_cached(image, resolution, output_size, selected_classes=selected_classes)
+        metadata["label_map_size"] = [label_map.shape[1], label_map.shape[0]]
+        with time_stage("service_encode"):
+            if output == "png":
+                return metadata, palette_png_bytes(filter_label_map(label_map, selected_classes), compress_level=1)
+            result = segment_masks(image, selected_classes, output, label_map=label_map)
+    metadata.update(format=output, masks=result["masks"])
+    return metadata, None
+
+def _respond(metadata, png):
+    """JSON metadata, or the PNG label map with the metadata in a header"""
+    if png is None:
+        return metadata
+    return Response(png, media_type="image/png", headers={"X-Garment-Seg-Metadata": json.dumps(metadata)})
+
+@app.exception_handler(MemoryBudgetError)
+async def memory_budget_exceeded(request, exc):
+    return JSONResponse({"detail": str(exc)}, status_code=503)
+
+@app.post("/classify-garment")
+async def classify_garment(request: Request):
+    """Classify a garment image posted as the raw request body"""
+    inc("garment_seg_requests_total", {"handler": "service_classify"})
+    data = await read_body(request)
+    return await coalesce(_request_key("classify", data), _classify, data)
+
+@app.post("/segment-person")
+async def segment_person(
+    request: Request,
+    classes: list[str] = Query(None, description="Classes to keep (default: all)"),
+    resolution: str = Query(None, description="Label map resolution: full, display or logits (default: GARMENT_SEG_SEGMENTATION_RESOLUTION)"),
+    size: str = Query(None, description="Label map size as WIDTHxHEIGHT, required for resolution=display"),
+    output: str = Query("rle", description="rle, bitplane or png"),
+):
+    """Segment a person image posted as the raw request body"""
+    inc("garment_seg_requests_total", {"handler": "service_segment"})
+    resolution, output_size = _check_options(resolution, output, size)
+    data = await read_body(request)
+    key = _request_key("segment", data, sorted(classes or []), resolution, output_size, output)
+    return _respond(*await coalesce(key, _segment, data, classes, resolution, output, output_size))
+
+@app.post("/segment-garment")
+async def segment_person_for_garment(
+    person: UploadFile = File(...),
+    garment: UploadFile = File(...),
+    resolution: str = Query(None, description="Label map resolution: full, display or logits (default: GARMENT_SEG_SEGMENTATION_RESOLUTION)"),
+    size: str = Query(None, description="Label map size as WIDTHxHEIGHT, required for resolution=display"),
+    output: str = Query("rle", description="rle, bitplane or png"),
+):
+    """Segment the parts of a person matching a garment, both posted as multipart files"""
+    inc("garment_seg_requests_total", {"handler": "service_combined"})
+    resolution, output_size = _check_options(resolution, output, size)
+    person_data, garment_data = await read_upload(person), await read_upload(garment)
+
+    garment_result = await coalesce(_request_key("classify", garment_data), _classify, garment_data)
+    if garment_result["selected_classes"] is None:
+        return {"garment": garment_result, "person": None}
+
+    selected_classes = garment_result["selected_classes"]
+    key = _request_key("segment", person_data, sorted(selected_classes), resolution, output_size, output)
+    metadata, png = await coalesce(key, _segment, person_data, selected_classes, resolution, output, output_size)
+    if png is None:
+        return {"garment": garment_result, "person": metadata}
+    return _respond(dict(metadata, garment=garment_result), png)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=config.SERVICE_HOST, port=config.SERVICE_PORT)
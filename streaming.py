@@ -0,0 +1,100 @@
+import time
+import threading
+
+import numpy as np
+from PIL import Image
+
+import config
+from segmentation import predict_class_label_map, segment_image, label_map_size
+from cache import get_segments_for_garment_cached
+from metrics import time_stage, inc
+
+# Video / webcam streaming. A session classifies its garment once, then for every frame
+# reuses the previous label map unless the frame changed noticeably, and drops frames that
+# arrive while the previous one is still being processed.
+
+def frame_thumbnail(frame, size=None):
+    """Small greyscale float copy of a frame used to measure change between frames"""
+    size = size or config.STREAM_DIFF_SIZE
+    return np.asarray(frame.convert("L").resize((size, size), Image.BILINEAR), dtype=np.float32)
+
+class StreamSession:
+    """Per-stream state: the garment's classes, the last label map and frame-rate counters"""
+
+    def __init__(self, garment_image, fixed_size=(400, 400), diff_threshold=None, resolution=None):
+        self.garment_image = garment_image
+        self.fixed_size = fixed_size
+        self.diff_threshold = config.STREAM_DIFF_THRESHOLD if diff_threshold is None else diff_threshold
+        self.resolution = resolution or config.STREAM_RESOLUTION
+        self.selected_class = None
+        self.result_text = None
+        self.counts = {"segmented": 0, "reused": 0, "dropped": 0}
+        self.fps = 0.0
+        self._classified = False
+        self._label_map = None
+        self._thumbnail = None
+        self._frame_size = None
+        self._last_output_time = None
+        self._lock = threading.Lock()
+
+    def _classify(self):
+        # The garment does not change during a stream, so it is classified once
+        with time_stage("classification"):
+            self.selected_class, _, self.result_text = get_segments_for_garment_cached(self.garment_image)
+        self._classified = True
+
+    def _needs_segmentation(self, frame, thumbnail):
+        if self._label_map is None or frame.size != self._frame_size:
+            return True
+        # Mean absolute change of the downscaled greyscale frame, in 0-255 units
+        return float(np.abs(thumbnail - self._thumbnail).mean()) > self.diff_threshold
+
+    def process(self, frame):
+        """Return the overlay for a frame, or None when the frame is dropped because the session is busy"""
+        if not self._lock.acquire(blocking=False):
+            self.counts["dropped"] += 1
+            inc("garment_seg_stream_frames_total", {"result": "dropped"})
+            return None
+        try:
+            if not self._classified:
+                self._classify()
+            if self.selected_class is None:
+                return None
+
+            thumbnail = frame_thumbnail(frame)
+            if self._needs_segmentation(frame, thumbnail):
+                with time_stage("segmentation"):
+                    self._label_map = predict_class_label_map(frame, self.selected_class, self.resolution, label_map_size(self.fixed_size, self.resolution))
+                self._thumbnail, self._frame_size = thumbnail, frame.size
+                result = "segmented"
+            else:
+                result = "reused"
+            self.counts[result] += 1
+            inc("garment_seg_stream_frames_total", {"result": result})
+
+            with time_stage("render"):
+                overlay = segment_image(frame, self.selected_class, False, False, True, self.fixed_size, self.resolution, label_map=self._label_map)[0]
+
+            # Exponential moving average of the output frame rate
+            now = time.perf_counter()
+            if self._last_output_time is not None:
+                instant = 1.0 / max(now - self._last_output_time, 1e-6)
+                self.fps = instant if self.fps == 0.0 else 0.9 * self.fps + 0.1 * instant
+            self._last_output_time = now
+            return overlay
+        finally:
+            self._lock.release()
+
+    def status(self):
+        """Classification and frame-rate summary shown next to the stream"""
+        if self._classified and self.selected_class is None:
+            return self.result_text
+        counts = self.counts
+        return (f"{self.result_text or ''}\n{self.fps:.1f} FPS - frames segmented {counts['segmented']}, "
+                f"reused {counts['reused']}, dropped {counts['dropped']}")
+
+def stream_frames(frames, garment_image, fixed_size=(400, 400), diff_threshold=None, resolution=None):
+    """Yield the overlay of every frame of an iterable (e.g. decoded video frames), reusing label maps between similar frames"""
+    session = StreamSession(garment_image, fixed_size, diff_threshold, resolution)
+    for frame in frames:
+        yield session.process(frame)
@@ -0,0 +1,122 @@
+import io
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pytest
+import requests
+from PIL import Image
+
+from fetch import ImageTooLargeError, fetch_bytes, fetch_image, fetch_images, fetch_images_async
+
+def _jpeg_bytes(size):
+    # Smooth content keeps the file small while the pixel count is large
+    width, height = size
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    pixels = np.broadcast_to(gradient[None, :, None], (height, width, 3))
+    buf = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(pixels)).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def _png_bytes(size, color=(10, 200, 30)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "PNG")
+    return buf.getvalue()
+
+def _palette_png_bytes(size):
+    buf = io.BytesIO()
+    Image.new("RGB", size, (10, 200, 30)).quantize(colors=4).save(buf, "PNG")
+    return buf.getvalue()
+
+BIG_JPEG = _jpeg_bytes((4000, 3000))
+SMALL_PNG = _png_bytes((64, 48))
+BIG_PALETTE_PNG = _palette_png_bytes((2048, 1536))
+PAYLOAD = b"x" * (256 * 1024)
+
+class _Handler(BaseHTTPRequestHandler):
+    """Stand-in image server: fixed bodies, a body without Content-Length and a 404"""
+
+    routes = {
+        "/big.jpg": ("image/jpeg", BIG_JPEG),
+        "/small.png": ("image/png", SMALL_PNG),
+        "/palette.png": ("image/png", BIG_PALETTE_PNG),
+        "/payload": ("application/octet-stream", PAYLOAD),
+    }
+
+    def do_GET(self):
+        if self.path == "/unannounced":
+            # Close-delimited body, so only the streamed byte count can enforce the cap
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+            self.close_connection = True
+            return
+        route = self.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, body = route
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_large_jpeg_is_draft_decoded_near_the_target(server):
+    image = fetch_image(f"{server}/big.jpg", target_size=(512, 512))
+    # JPEG draft mode picks the smallest 1/2^n scale that still covers the target
+    assert image.mode == "RGB"
+    assert image.size == (1000, 750)
+
+def test_small_image_is_not_reduced(server):
+    image = fetch_image(f"{server}/small.png", target_size=(512, 512))
+    assert image.size == (64, 48)
+    assert image.getpixel((0, 0)) == (10, 200, 30)
+
+def test_large_palette_png_is_reduced_in_rgb(server):
+    image = fetch_image(f"{server}/palette.png", target_size=(512, 512))
+    assert image.mode == "RGB"
+    assert image.size == (683, 512)  # reduce(3) rounds the size up
+    assert image.getpixel((0, 0)) == (10, 200, 30)
+
+def test_announced_body_over_the_byte_cap_is_rejected(server):
+    with pytest.raises(ImageTooLargeError):
+        fetch_bytes(f"{server}/payload", max_bytes=1024)
+    assert fetch_bytes(f"{server}/payload", max_bytes=len(PAYLOAD)) == PAYLOAD
+
+def test_streamed_body_over_the_byte_cap_is_rejected(server):
+    with pytest.raises(ImageTooLargeError):
+        fetch_bytes(f"{server}/unannounced", max_bytes=100 * 1024)
+    assert fetch_bytes(f"{server}/unannounced", max_bytes=len(PAYLOAD)) == PAYLOAD
+
+def test_missing_image_raises_http_error(server):
+    with pytest.raises(requests.HTTPError) as excinfo:
+        fetch_image(f"{server}/missing.jpg")
+    assert excinfo.value.response.status_code == 404
+
+def test_fetch_images_returns_results_and_errors_in_order(server):
+    urls = [f"{server}/small.png", f"{server}/missing.jpg", f"{server}/big.jpg", f"{server}/small.png"]
+    results = fetch_images(urls, target_size=(512, 512))
+    assert [type(result) for result in results] == [Image.Image, requests.HTTPError, Image.Image, Image.Image]
+    assert results[2].size == (1000, 750)
+
+def test_fetch_images_async_fetches_concurrently(server):
+    urls = [f"{server}/small.png"] * 8 + [f"{server}/payload"]
+    results = asyncio.run(fetch_images_async(urls, target_size=(512, 512), max_bytes=64 * 1024))
+    assert all(isinstance(result, Image.Image) and result.size == (64, 48) for result in results[:8])
+    assert isinstance(results[8], ImageTooLargeError)
@@ -0,0 +1,83 @@
+import os
+import json
+import tempfile
+
+import torch
+from transformers import (
+    SegformerConfig, SegformerForSemanticSegmentation, SegformerImageProcessor,
+    CLIPConfig, CLIPModel, CLIPImageProcessor, CLIPProcessor, CLIPTokenizer,
+)
+
+import models
+from constants import class_names
+
+# Tiny randomly-initialised stand-ins for SegFormer and Fashion-CLIP. They keep the
+# real processors' input geometry, so benchmarks and load tests exercise the same
+# code paths offline, without downloading any weights.
+
+def _bytes_to_unicode():
+    """The byte -> unicode table used by CLIP's byte-level BPE"""
+    byte_values = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    code_points = byte_values[:]
+    extra = 0
+    for b in range(256):
+        if b not in byte_values:
+            byte_values.append(b)
+            code_points.append(256 + extra)
+            extra += 1
+    return dict(zip(byte_values, [chr(c) for c in code_points]))
+
+def build_tiny_tokenizer(directory=None):
+    """Build a character-level CLIP tokenizer (no BPE merges) without network access"""
+    directory = directory or tempfile.mkdtemp(prefix="tiny_clip_tokenizer_")
+    characters = list(_bytes_to_unicode().values())
+    tokens = characters + [character + "</w>" for character in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    
+    vocab_path = os.path.join(directory, "vocab.json")
+    merges_path = os.path.join(directory, "merges.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(merges_path, "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_path, merges_path)
+
+def build_tiny_segformer(seed=0):
+    """Return a (processor, model) pair for a tiny random SegFormer"""
+    torch.manual_seed(seed)
+    model_config = SegformerConfig(
+        num_labels=len(class_names),
+        hidden_sizes=[16, 32, 64, 128],
+        depths=[1, 1, 1, 1],
+        num_attention_heads=[1, 2, 2, 4],
+        decoder_hidden_size=64,
+    )
+    model = SegformerForSemanticSegmentation(model_config).eval()
+    model.config._name_or_path = f"tiny-random-segformer-{seed}"
+    processor = SegformerImageProcessor(size={"height": 512, "width": 512})
+    return processor, model
+
+def build_tiny_clip(seed=0):
+    """Return a (model, processor) pair for a tiny random CLIP"""
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+    model_config = CLIPConfig(
+        text_config=dict(
+            vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64,
+            num_hidden_layers=2, num_attention_heads=2, max_position_embeddings=77,
+            bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+        ),
+        vision_config=dict(
+            hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, image_size=224, patch_size=32,
+        ),
+        projection_dim=32,
+    )
+    model = CLIPModel(model_config).eval()
+    model.config._name_or_path = f"tiny-random-clip-{seed}"
+    processor = CLIPProcessor(image_processor=CLIPImageProcessor(), tokenizer=tokenizer)
+    return model, processor
+
+def install_tiny_models(seed=0):
+    """Register tiny random models in place of the pretrained ones"""
+    models.set_model("segformer", build_tiny_segformer(seed))
+    models.set_model("clip", build_tiny_clip(seed))
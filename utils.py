@@ -1,34 +1,111 @@
-import requests
-from PIL import Image
+import time
+
 import gradio as gr
 
-from segmentation import segment_image
-from classification import get_segments_for_garment
+import config
+from segmentation import SEGMENT_OUTPUTS, segment_image, iter_segment_images, label_map_size
+from cache import get_segments_for_garment_cached, get_segments_for_garments_cached, predict_label_map_cached
+from metrics import time_stage, inc, observe, observe_image
+from fetch import fetch_image
+from memory import memory_guard, estimate_render_bytes
 
 def process_url(url, selected_classes, show_original, show_segmentation, show_overlay, fixed_size=(400, 400)):
     """Process an image from a URL"""
     try:
-        image = Image.open(requests.get(url, stream=True).raw)
+        image = fetch_image(url)
         return segment_image(image, selected_classes, show_original, show_segmentation, show_overlay, fixed_size)
     except Exception as e:
         return [gr.update(value=None)] * 4, f"Error: {str(e)}"
 
 def process_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay, fixed_size=(400, 400)):
     """Process person and garment images for targeted segmentation"""
+    # The progressive handler's last update holds every result
+    for result in stream_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay, fixed_size):
+        pass
+    return result
+
+def stream_person_and_garment(person_image, garment_image, show_original, show_segmentation, show_overlay, fixed_size=(400, 400)):
+    """process_person_and_garment as a generator: yields the classification text first, then the overlay, then all images"""
     if person_image is None or garment_image is None:
-        return [gr.update(value=None)] * 4, "Please provide both person and garment images"
+        yield [gr.update(value=None)] * 4, "Please provide both person and garment images"
+        return
     
+    inc("garment_seg_requests_total", {"handler": "person_and_garment"})
+    start = time.perf_counter()
+    
+    # Stages are timed between yields only: the generator may be resumed on another thread
     try:
-        # Get segments that should be included based on the garment
-        selected_class, segformer_idx, result_text = get_segments_for_garment(garment_image)
+        observe_image(person_image, "person")
+        observe_image(garment_image, "garment")
         
+        # Get segments that should be included based on the garment
+        with time_stage("classification"):
+            selected_class, segformer_idx, result_text = get_segments_for_garment_cached(garment_image)
+        observe("garment_seg_stage_seconds", time.perf_counter() - start, {"stage": "first_result"})
         if selected_class is None:
-            return [gr.update(value=None)] * 4, result_text
+            yield [gr.update(value=None)] * 4, result_text
+            return
+        yield [], result_text
+        
+        # Large images are downscaled or wait when they would exceed the memory budget. The
+        # budget is only reserved while rendering, never across a yield, so a slow or
+        # abandoned consumer cannot hold it
+        with memory_guard.admit(person_image, fixed_size=fixed_size) as person_image:
+            # The person's label map is cached on its own (per class selection in coarse-to-fine mode)
+            with time_stage("segmentation"):
+                label_map = predict_label_map_cached(person_image, output_size=label_map_size(fixed_size), selected_classes=selected_class)
+            
+            # The overlay is rendered first and shown on its own
+            images = iter_segment_images(person_image, selected_class, show_original, show_segmentation, show_overlay, fixed_size, label_map=label_map, overlay_first=True)
+            kind, output = next(images)
+            rendered = {kind: output}
+        
+        if kind == "overlay":
+            observe("garment_seg_stage_seconds", time.perf_counter() - start, {"stage": "first_image"})
+            yield [output], result_text
         
-        # Process the person image with the selected garment classes
-        result_images = segment_image(person_image, selected_class, show_original, show_segmentation, show_overlay, fixed_size)
+        # Then the remaining images, shown with the overlay in the gallery's usual order; the
+        # model is done, so only the rendering footprint is reserved
+        with memory_guard.reserve(estimate_render_bytes(person_image.size, fixed_size=fixed_size)):
+            rendered.update(images)
         
-        return result_images, result_text
+        observe("garment_seg_stage_seconds", time.perf_counter() - start, {"stage": "total"})
+        yield [rendered[kind] for kind in SEGMENT_OUTPUTS if kind in rendered], result_text
     
     except Exception as e:
-        return [gr.update(value=None)] * 4, f"Error: {str(e)}"
+        inc("garment_seg_errors_total", {"handler": "person_and_garment"})
+        yield [gr.update(value=None)] * 4, f"Error: {str(e)}"
+
+def process_person_and_garments(person_image, garment_images, show_original, show_segmentation, show_overlay, fixed_size=(400, 400)):
+    """Segment one person for several garments, running SegFormer on the person only once"""
+    if person_image is None or not garment_images:
+        return [([gr.update(value=None)] * 4, "Please provide a person image and at least one garment image")]
+    
+    try:
+        # Classify all garments together and segment the person once, within the memory budget
+        garment_results = get_segments_for_garments_cached(garment_images)
+        with memory_guard.admit(person_image, fixed_size=fixed_size) as person_image:
+            # One label map serves every garment, unless coarse-to-fine maps are refined per selection
+            shared_label_map = None
+            if config.SEGMENTATION_STRATEGY != "roi":
+                shared_label_map = predict_label_map_cached(person_image, output_size=label_map_size(fixed_size))
+            
+            results = []
+            for selected_class, segformer_idx, result_text in garment_results:
+                if selected_class is None:
+                    results.append(([gr.update(value=None)] * 4, result_text))
+                    continue
+                
+                # Apply this garment's class selection to the label map
+                try:
+                    label_map = shared_label_map
+                    if label_map is None:
+                        label_map = predict_label_map_cached(person_image, output_size=label_map_size(fixed_size), selected_classes=selected_class)
+                    result_images = segment_image(person_image, selected_class, show_original, show_segmentation, show_overlay, fixed_size, label_map=label_map)
+                    results.append((result_images, result_text))
+                except Exception as e:
+                    results.append(([gr.update(value=None)] * 4, f"Error: {str(e)}"))
+    except Exception as e:
+        return [([gr.update(value=None)] * 4, f"Error: {str(e)}")] * len(garment_images)
+    
+    return results
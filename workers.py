@@ -0,0 +1,108 @@
+import os
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+import config
+import metrics
+from models import warmup
+from classification import get_text_embeddings
+from utils import process_person_and_garment
+
+class PoolBusyError(RuntimeError):
+    """Raised when the worker pool's request queue is full"""
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def core_slices(workers, threads_per_worker=None):
+    """Split the available cores into one contiguous slice per worker"""
+    cores = _available_cores()
+    threads = threads_per_worker or max(1, len(cores) // workers)
+    return [[cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(workers)]
+
+@contextmanager
+def _single_threaded():
+    """Run torch ops on the calling thread only, so no OpenMP thread pool is started"""
+    previous = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+def _init_worker(slices):
+    """Pin the worker to its slice of cores and size torch's thread pool to match"""
+    # Values recorded by the parent before the fork are the parent's to report
+    metrics.drain()
+    cores = slices.get()
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError:
+            pass  # Pinning is best effort (e.g. restricted containers)
+    torch.set_num_threads(len(cores))
+
+def _run(fn, *args):
+    """Run fn(*args) on a worker, returning its result and the metrics it recorded"""
+    result = fn(*args)
+    return result, metrics.drain()
+
+class InferencePool:
+    """Process pool for process_person_and_garment with pinned cores and a bounded queue
+
+    With fork, the pool must be created before the process runs a multi-threaded torch op:
+    a child forked after OpenMP started its threads hangs in its first parallel region.
+    """
+
+    def __init__(self, workers=None, threads_per_worker=None, max_pending=None, queue_timeout=None):
+        self.workers = workers or config.WORKER_PROCESSES
+        self.max_pending = max_pending or config.WORKER_MAX_PENDING or 2 * self.workers
+        self.queue_timeout = config.WORKER_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+
+        use_fork = "fork" in multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if use_fork else "spawn")
+        slices = context.Queue()
+        for cores in core_slices(self.workers, threads_per_worker or config.WORKER_THREADS):
+            slices.put(cores)
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker, initargs=(slices,))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+        with _single_threaded():
+            if use_fork:
+                # Load the weights before forking so every worker maps the same read-only pages
+                # instead of holding its own copy. Without fork each worker loads lazily, and
+                # weights from a local safetensors snapshot are still shared via the page cache.
+                # The warmup runs single-threaded so the children inherit no OpenMP threads.
+                warmup()
+                get_text_embeddings()
+            # Start the workers now: forking later, once the app's server threads run, is unsafe
+            for future in [self._executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) on a worker, or raise PoolBusyError when the queue stays full"""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise PoolBusyError(f"{self.max_pending} requests already pending")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def process_person_and_garment(self, *args):
+        """Run process_person_and_garment on a worker and wait for the result"""
+        # The worker's stage timings and counters are added to this process's /metrics
+        result, recorded = self.submit(_run, process_person_and_garment, *args).result()
+        metrics.merge(recorded)
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown()